@@ -0,0 +1,160 @@
+import datetime
+import json
+import logging
+import threading
+
+from django.db import connection, transaction
+from django.utils import timezone
+
+from dlms import settings
+from content_management.models import ImportJob, LibraryBuild
+from content_management.sheet_readers import read_sheet_rows
+from content_management.utils import ContentSheetUtil, LibraryBuildUtil
+
+logger = logging.getLogger(__name__)
+
+# seconds between updates of a running job's updated_on
+HEARTBEAT_INTERVAL = 30
+
+
+def claim_next_job(model):
+    """
+    Marks the oldest queued job of model as running and returns it
+    Rows locked by other workers are skipped, so several workers can share a queue
+    :param model: job model with state and started_on fields
+    :return: the claimed job or None if the queue is empty
+    """
+    with transaction.atomic():
+        job = model.objects.select_for_update(skip_locked=True) \
+            .filter(state=model.QUEUED).order_by('id').first()
+        if job is None:
+            return None
+        job.state = model.RUNNING
+        job.started_on = job.updated_on = timezone.now()
+        job.save(update_fields=['state', 'started_on', 'updated_on'])
+    return job
+
+
+def fail_stale_jobs():
+    """
+    Fails running jobs whose worker stopped refreshing them for JOB_STALE_MINUTES,
+    such as a worker that was killed or redeployed in the middle of a job
+    :return: number of jobs failed
+    """
+    now = timezone.now()
+    stale_before = now - datetime.timedelta(minutes=settings.JOB_STALE_MINUTES)
+    failed = 0
+    for model, run_job in JOB_RUNNERS:
+        count = model.objects.filter(state=model.RUNNING, updated_on__lt=stale_before).update(
+            state=model.FAILED,
+            finished_on=now,
+            error='The worker running this job stopped before it finished'
+        )
+        if count:
+            logger.warning("Failed %s stale %s jobs", count, model.__name__)
+        failed += count
+    return failed
+
+
+def run_with_heartbeat(job, run_job):
+    """
+    Runs a claimed job while a thread refreshes its updated_on every HEARTBEAT_INTERVAL seconds
+    """
+    done = threading.Event()
+
+    def beat():
+        try:
+            while not done.wait(HEARTBEAT_INTERVAL):
+                type(job).objects.filter(id=job.id).update(updated_on=timezone.now())
+        finally:
+            connection.close()
+
+    heartbeat = threading.Thread(target=beat, daemon=True)
+    heartbeat.start()
+    try:
+        run_job(job)
+    finally:
+        done.set()
+        heartbeat.join()
+
+
+def run_import_job(job: ImportJob):
+    def report_progress(rows_done, unsuccessful_uploads, rows_skipped):
+        ImportJob.objects.filter(id=job.id).update(
+            rows_done=rows_done,
+            rows_failed=len(unsuccessful_uploads),
+            rows_skipped=rows_skipped
+        )
+
+    try:
+        with job.sheet_file.open("rb") as sheet_file:
+            result = ContentSheetUtil(incremental=job.incremental).upload_sheet_rows(
+                read_sheet_rows(sheet_file, job.sheet_format),
+                job.content_path,
+                progress=report_progress
+            )
+    except Exception as e:
+        result = {'success': False, 'error': str(e)}
+
+    job.refresh_from_db(fields=['rows_done', 'rows_failed', 'rows_skipped'])
+    job.finished_on = timezone.now()
+    if 'error' in result:
+        logger.error("Import job %s failed: %s", job.id, result['error'])
+        job.state = ImportJob.FAILED
+        job.error = result['error']
+    else:
+        job.state = ImportJob.FINISHED
+        job.rows_skipped = result.get('skipped_count', 0)
+        job.rows_done = result['success_count'] + len(result['unsuccessful_uploads']) + job.rows_skipped
+        job.rows_failed = len(result['unsuccessful_uploads'])
+        job.unsuccessful_uploads = json.dumps(result['unsuccessful_uploads'])
+    job.save()
+
+
+def run_build_job(build: LibraryBuild):
+    row_counts = {}
+
+    def report_progress(table, rows_written):
+        if rows_written is not None:
+            row_counts[table] = rows_written
+        LibraryBuild.objects.filter(id=build.id).update(stage=table, row_counts=json.dumps(row_counts))
+
+    try:
+        build_util = LibraryBuildUtil()
+        build.output_path = build_util.build_library(build.version_id, build.id, progress=report_progress)
+        if build.package:
+            build.package_path = build_util.stage_package(build.version_id, build.output_path, build.id,
+                                                          progress=report_progress)
+        if build.base_version_id is not None:
+            build.delta_path = build_util.stage_delta(build.version_id, build.base_version_id, build.output_path,
+                                                      build.id, progress=report_progress)
+        build.state = LibraryBuild.FINISHED
+    except Exception as e:
+        logger.error("Library build %s failed: %s", build.id, e)
+        build.state = LibraryBuild.FAILED
+        build.error = str(e)
+
+    build.finished_on = timezone.now()
+    build.stage = None
+    build.row_counts = json.dumps(row_counts)
+    build.save()
+
+
+JOB_RUNNERS = (
+    (ImportJob, run_import_job),
+    (LibraryBuild, run_build_job),
+)
+
+
+def run_next_job():
+    """
+    Runs the oldest queued job, taking imports before library builds
+    :return: True if a job was run
+    """
+    for model, run_job in JOB_RUNNERS:
+        job = claim_next_job(model)
+        if job is not None:
+            logger.info("Running %s", job)
+            run_with_heartbeat(job, run_job)
+            return True
+    return False
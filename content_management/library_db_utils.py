@@ -1,13 +1,78 @@
-import os
 import sqlite3
-from sqlite3 import Error
+from contextlib import closing
 
-from dlms import settings
+
+# Settings for a loader that owns a new, private database file. A crash can leave the file corrupt,
+# which is acceptable because a failed build deletes it
+BULK_LOAD_PRAGMAS = (
+    'PRAGMA journal_mode = OFF',
+    'PRAGMA synchronous = OFF',
+    'PRAGMA locking_mode = EXCLUSIVE',
+    'PRAGMA temp_store = MEMORY',
+    'PRAGMA cache_size = -262144',  # 256 MiB
+)
+# Matches the 4 KiB blocks of the filesystem and flash storage the library is read from on the device
+PAGE_SIZE = 4096
+
+
+# Lookups the device makes while browsing, each of which should be answered by an index
+DEVICE_QUERIES = {
+    'subfolders': 'SELECT id, folder_name, logo FROM folder WHERE parent_id = ? ORDER BY folder_name',
+    'folder contents': 'SELECT content_id, title, file_size FROM content_folder WHERE folder_id = ? ORDER BY title',
+    'content folders': 'SELECT folder_id FROM content_folder WHERE content_id = ?',
+    'metadata contents': 'SELECT content_id FROM content_metadata WHERE metadata_id = ?',
+    'content metadata': 'SELECT metadata_id FROM content_metadata WHERE content_id = ?',
+    'type metadata': 'SELECT id, meta_name FROM metadata WHERE type_id = ? ORDER BY meta_name',
+}
+
+# Ranked full-text search of contents on the device, MATCH takes an FTS5 query such as 'solar* energy'
+SEARCH_QUERY = 'SELECT content.id, content.title, content.file_name FROM content_search ' \
+               'JOIN content ON content.id = content_search.rowid ' \
+               'WHERE content_search MATCH ? ORDER BY rank LIMIT ?'
+
+SQL_CREATE_SEARCH_TABLE = """CREATE VIRTUAL TABLE content_search USING fts5(
+                                 title, description, metadata,
+                                 content='', prefix='2 3', tokenize='unicode61 remove_diacritics 2'
+                             );"""
+SQL_FILL_SEARCH_TABLE = """INSERT INTO content_search (rowid, title, description, metadata)
+                           SELECT content.id, content.title, content.description,
+                                  group_concat(metadata.meta_name, ' ')
+                           FROM content
+                           LEFT JOIN content_metadata ON content_metadata.content_id = content.id
+                           LEFT JOIN metadata ON metadata.id = content_metadata.metadata_id
+                           GROUP BY content.id;"""
+SQL_OPTIMIZE_SEARCH_TABLE = "INSERT INTO content_search (content_search) VALUES ('optimize');"
+
+# Columns that identify a row of each table, in the order tables are filled
+TABLE_KEYS = (
+    ('metadata_type', ('id',)),
+    ('metadata', ('id',)),
+    ('folder', ('id',)),
+    ('module', ('id',)),
+    ('content', ('id',)),
+    ('content_metadata', ('content_id', 'metadata_id')),
+    ('content_folder', ('content_id', 'folder_id')),
+    ('folder_stats', ('folder_id',)),
+    ('metadata_stats', ('metadata_id',)),
+)
+# Rows per statement in an SQL patch
+PATCH_BATCH_SIZE = 500
 
 
 class LibraryDbUtil:
+    # CREATE INDEX statements, run after the tables are loaded so each index is built once in a single sorted pass
+    # instead of being updated on every insert
+    indexes = (
+        'CREATE INDEX folder_parent_idx ON folder (parent_id, folder_name)',
+        'CREATE INDEX content_folder_folder_idx ON content_folder (folder_id, title, content_id, file_size)',
+        'CREATE INDEX content_folder_content_idx ON content_folder (content_id, folder_id)',
+        'CREATE INDEX content_metadata_metadata_idx ON content_metadata (metadata_id, content_id)',
+        'CREATE INDEX content_metadata_content_idx ON content_metadata (content_id, metadata_id)',
+        'CREATE INDEX metadata_type_idx ON metadata (type_id, meta_name)',
+    )
 
-    def __init__(self, metadata_types, metadata, folders, modules, contents, contents_metadata, contents_folder):
+    def __init__(self, metadata_types, metadata, folders, modules, contents, contents_metadata, contents_folder,
+                 folder_stats=(), metadata_stats=(), progress=None, bulk_load=False):
         self.metadata_types = metadata_types
         self.metadata = metadata
         self.modules = modules
@@ -15,22 +80,18 @@ class LibraryDbUtil:
         self.contents = contents
         self.content_metadata = contents_metadata
         self.content_folder = contents_folder
-
+        self.folder_stats = folder_stats
+        self.metadata_stats = metadata_stats
+        self.progress = progress
+        self.bulk_load = bulk_load
 
     def create_connection(self, db_file):
         """ create a database connection to the SQLite database
             specified by db_file
         :param db_file: database file
-        :return: Connection object or None
+        :return: Connection object
         """
-        conn = None
-        try:
-            conn = sqlite3.connect(db_file)
-            return conn
-        except Error as e:
-            print(e)
-
-        return conn
+        return sqlite3.connect(db_file)
 
     def create_table(self, conn, create_table_sql):
         """ create a table from the create_table_sql statement
@@ -38,55 +99,92 @@ class LibraryDbUtil:
         :param create_table_sql: a CREATE TABLE statement
         :return:
         """
-        try:
-            c = conn.cursor()
-            c.execute(create_table_sql)
-        except Error as e:
-            print(e)
+        c = conn.cursor()
+        c.execute(create_table_sql)
+
+    def configure_connection(self, conn):
+        """ set the page size, and the loader pragmas when in bulk load mode
+        must run before any table is created
+        :param conn: Connection object
+        :return:
+        """
+        c = conn.cursor()
+        c.execute(f'PRAGMA page_size = {PAGE_SIZE}')
+        if self.bulk_load:
+            for pragma in BULK_LOAD_PRAGMAS:
+                c.execute(pragma)
 
     def insert_data(self, conn):
         """ insert bulk data from DLMS to sqlite
+        progress is called with the table name before each table is written,
+        and again with the number of rows written once it is done
+        :param conn: Connection object
+        :return:
+        """
+        c = conn.cursor()
+        for table, insert_sql, rows in (
+            ('metadata_type', 'INSERT INTO metadata_type VALUES (?,?)', self.metadata_types),
+            ('metadata', 'INSERT INTO metadata VALUES (?,?,?,?)', self.metadata),
+            ('folder', 'INSERT INTO folder VALUES (?,?,?,?)', self.folders),
+            ('module', 'INSERT INTO module VALUES (?,?,?)', self.modules),
+            ('content', 'INSERT INTO content VALUES (?,?,?,?,?,?,?,?)', self.contents),
+            ('content_metadata', 'INSERT INTO content_metadata VALUES (?,?)', self.content_metadata),
+            ('content_folder', 'INSERT INTO content_folder VALUES (?,?,?,?)', self.content_folder),
+            ('folder_stats', 'INSERT INTO folder_stats VALUES (?,?,?)', self.folder_stats),
+            ('metadata_stats', 'INSERT INTO metadata_stats VALUES (?,?)', self.metadata_stats),
+        ):
+            if self.progress is not None:
+                self.progress(table, None)
+            c.executemany(insert_sql, rows)
+            if self.progress is not None:
+                self.progress(table, c.rowcount)
+
+    def create_search_index(self, conn):
+        """ build the content_search full text index over the titles, descriptions and metadata names of contents
+        The table is contentless, its rowid is the content id, so the text is not stored a second time.
+        Prefix indexes on 2 and 3 characters make the prefix queries of search as you type fast
         :param conn: Connection object
         :return:
         """
-        try:
-            c = conn.cursor()
-            c.executemany('INSERT INTO metadata_type VALUES (?,?)', self.metadata_types)
-            c.executemany('INSERT INTO metadata VALUES (?,?,?,?)', self.metadata)
-            c.executemany('INSERT INTO folder VALUES (?,?,?,?)', self.folders)
-            c.executemany('INSERT INTO module VALUES (?,?,?)', self.modules)
-            c.executemany('INSERT INTO content VALUES (?,?,?,?,?,?,?,?)', self.contents)
-            c.executemany('INSERT INTO content_metadata VALUES (?,?)', self.content_metadata)
-            c.executemany('INSERT INTO content_folder VALUES (?,?,?,?)', self.content_folder)
-        except Error as e:
-            print(e)
-
-    def create_library_db(self):
-        database = os.path.join(os.path.abspath(settings.BUILDS_ROOT), 'solarspell.db')
-        sql_create_metadata_type_table = """CREATE TABLE IF NOT EXISTS metadata_type (
+        if self.progress is not None:
+            self.progress('content_search', None)
+        c = conn.cursor()
+        c.execute(SQL_CREATE_SEARCH_TABLE)
+        c.execute(SQL_FILL_SEARCH_TABLE)
+        if self.progress is not None:
+            self.progress('content_search', c.rowcount)
+        c.execute(SQL_OPTIMIZE_SEARCH_TABLE)
+
+    def create_library_db(self, database):
+        """ create the library database, raising on any error
+        indexes and the search index are created once all rows are inserted
+        :param database: path of a new, empty database file
+        :return: path of the database file
+        """
+        sql_create_metadata_type_table = """CREATE TABLE metadata_type (
                                         id INTEGER PRIMARY KEY,
                                         type_name TEXT NOT NULL
                                     );"""
-        sql_create_metadata_table = """CREATE TABLE IF NOT EXISTS metadata (
+        sql_create_metadata_table = """CREATE TABLE metadata (
                                         id INTEGER PRIMARY KEY,
                                         meta_name TEXT NOT NULL,
                                         type_name TEXT NOT NULL,
                                         type_id INTEGER NOT NULL, 
                                         FOREIGN KEY (type_id) REFERENCES metadata_type (id)
                                     );"""
-        sql_create_folder_table = """ CREATE TABLE IF NOT EXISTS folder (
+        sql_create_folder_table = """ CREATE TABLE folder (
                                             id INTEGER PRIMARY KEY,
                                             folder_name TEXT NOT NULL,
                                             logo TEXT,
                                             parent_id INTEGER, 
                                             FOREIGN KEY (parent_id) REFERENCES folder (id)
                                         );"""
-        sql_create_module_table = """ CREATE TABLE IF NOT EXISTS module (
+        sql_create_module_table = """ CREATE TABLE module (
                                             id INTEGER PRIMARY KEY,
                                             module_name TEXT NOT NULL,
                                             logo TEXT
         );                                 """
-        sql_create_content_table = """ CREATE TABLE IF NOT EXISTS content (
+        sql_create_content_table = """ CREATE TABLE content (
                                             id INTEGER PRIMARY KEY,
                                             title text NOT NULL,
                                             description TEXT,
@@ -96,13 +194,13 @@ class LibraryDbUtil:
                                             rights_statement TEXT,
                                             file_size REAL
                                         ); """
-        sql_create_content_metadata_table = """ CREATE TABLE IF NOT EXISTS content_metadata (
+        sql_create_content_metadata_table = """ CREATE TABLE content_metadata (
                                                content_id INTEGER NOT NULL,
                                                metadata_id INTEGER NOT NULL,
                                                FOREIGN KEY (content_id) REFERENCES content (id)                                                               
                                                FOREIGN KEY (metadata_id) REFERENCES metadata (id)                             
                                            ); """
-        sql_create_content_folder_table = """ CREATE TABLE IF NOT EXISTS content_folder (
+        sql_create_content_folder_table = """ CREATE TABLE content_folder (
                                                content_id INTEGER NOT NULL,
                                                folder_id INTEGER NOT NULL,
                                                title TEXT,
@@ -110,11 +208,24 @@ class LibraryDbUtil:
                                                FOREIGN KEY (content_id) REFERENCES content (id)                                                               
                                                FOREIGN KEY (folder_id) REFERENCES folder (id)                             
                                            ); """
+        # contents of each folder and all of its subfolders, each content counted once
+        sql_create_folder_stats_table = """ CREATE TABLE folder_stats (
+                                               folder_id INTEGER PRIMARY KEY,
+                                               content_count INTEGER NOT NULL,
+                                               total_size REAL NOT NULL,
+                                               FOREIGN KEY (folder_id) REFERENCES folder (id)
+                                           ); """
+        # contents of the library tagged with each metadata
+        sql_create_metadata_stats_table = """ CREATE TABLE metadata_stats (
+                                               metadata_id INTEGER PRIMARY KEY,
+                                               content_count INTEGER NOT NULL,
+                                               FOREIGN KEY (metadata_id) REFERENCES metadata (id)
+                                           ); """
 
         # create a database connection
-        conn = self.create_connection(database)
+        with closing(self.create_connection(database)) as conn:
+            self.configure_connection(conn)
 
-        if conn is not None:
             # create tables
             self.create_table(conn, sql_create_metadata_type_table)
             self.create_table(conn, sql_create_metadata_table)
@@ -123,10 +234,82 @@ class LibraryDbUtil:
             self.create_table(conn, sql_create_content_table)
             self.create_table(conn, sql_create_content_metadata_table)
             self.create_table(conn, sql_create_content_folder_table)
+            self.create_table(conn, sql_create_folder_stats_table)
+            self.create_table(conn, sql_create_metadata_stats_table)
 
             # insert data
             self.insert_data(conn)
             conn.commit()
-        else:
-            print("Error! cannot create the database connection.")
-        conn.close()
+
+            for create_index_sql in self.indexes:
+                conn.execute(create_index_sql)
+            self.create_search_index(conn)
+            conn.commit()
+
+            if self.bulk_load:
+                # gather query planner statistics and rewrite the file without free pages
+                conn.execute('ANALYZE')
+                conn.commit()
+                conn.execute('VACUUM')
+        return database
+
+
+def query_plan_problems(conn):
+    """ check that the device queries are answered by indexes
+    :param conn: Connection object of a built library database
+    :return: list of (query name, plan detail) for each full scan or temporary sort
+    """
+    problems = []
+    for name, query in DEVICE_QUERIES.items():
+        for row in conn.execute('EXPLAIN QUERY PLAN ' + query, (1,)):
+            detail = row[-1]
+            if detail.startswith('SCAN') or 'TEMP B-TREE' in detail:
+                problems.append((name, detail))
+    return problems
+
+
+def write_sql_patch(base_database, database, patch_file):
+    """ write the SQL that turns the library database base_database into database
+    Rows that were removed or changed are deleted by key and rows that were added or changed are inserted,
+    the search index is then rebuilt since a contentless FTS5 table cannot delete rows by id alone.
+    The patch runs in one transaction, so a device left with a partial update keeps its old library
+    :param base_database: path of the database on the device
+    :param database: path of the database to update it to
+    :param patch_file: text file the SQL is written to
+    :return: dict of table name to (rows deleted, rows inserted)
+    """
+    counts = {}
+    with closing(sqlite3.connect(database)) as conn:
+        conn.execute('ATTACH DATABASE ? AS base', (base_database,))
+        patch_file.write('BEGIN;\n')
+
+        # children before parents when deleting, parents before children when inserting
+        for table, keys in reversed(TABLE_KEYS):
+            key_columns = ', '.join(keys)
+            quoted_keys = ', '.join(f'quote({key})' for key in keys)
+            rows = conn.execute(f'SELECT {quoted_keys} FROM (SELECT * FROM base.{table} '
+                                f'EXCEPT SELECT * FROM main.{table})')
+            deleted = 0
+            for batch in iter(lambda: rows.fetchmany(PATCH_BATCH_SIZE), []):
+                values = ', '.join(f'({", ".join(row)})' for row in batch)
+                patch_file.write(f'DELETE FROM {table} WHERE ({key_columns}) IN (VALUES {values});\n')
+                deleted += len(batch)
+            counts[table] = (deleted, 0)
+
+        for table, keys in TABLE_KEYS:
+            columns = [column[1] for column in conn.execute(f'PRAGMA main.table_info({table})')]
+            quoted_columns = ', '.join(f'quote({column})' for column in columns)
+            rows = conn.execute(f'SELECT {quoted_columns} FROM (SELECT * FROM main.{table} '
+                                f'EXCEPT SELECT * FROM base.{table})')
+            inserted = 0
+            for batch in iter(lambda: rows.fetchmany(PATCH_BATCH_SIZE), []):
+                values = ', '.join(f'({", ".join(row)})' for row in batch)
+                patch_file.write(f'INSERT INTO {table} VALUES {values};\n')
+                inserted += len(batch)
+            counts[table] = (counts[table][0], inserted)
+
+        patch_file.write('DROP TABLE content_search;\n')
+        for statement in (SQL_CREATE_SEARCH_TABLE, SQL_FILL_SEARCH_TABLE, SQL_OPTIMIZE_SEARCH_TABLE):
+            patch_file.write(statement + '\n')
+        patch_file.write('COMMIT;\nANALYZE;\n')
+    return counts
@@ -0,0 +1,42 @@
+import os
+
+from django.core.management.base import BaseCommand
+
+from content_management.models import Content
+from content_management.utils import sha256
+
+
+class Command(BaseCommand):
+    help = "Stores the SHA-256 and size of every content file that does not have one yet"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true', help="Rehash contents that already have a hash")
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, **options):
+        queryset = Content.objects.exclude(content_file='').only('id', 'content_file')
+        if not options['all']:
+            queryset = queryset.filter(content_hash__isnull=True)
+
+        batch = []
+        hashed_count = 0
+        missing_count = 0
+        for content in queryset.iterator(chunk_size=options['batch_size']):
+            path = content.content_file.path
+            if not os.path.isfile(path):
+                missing_count += 1
+                self.stderr.write(f'Missing file for content {content.id}: {path}')
+                continue
+            with open(path, "rb") as content_file:
+                content.content_hash = sha256(content_file)
+            content.filesize = os.path.getsize(path)
+            batch.append(content)
+            if len(batch) >= options['batch_size']:
+                Content.objects.bulk_update(batch, ['content_hash', 'filesize'])
+                hashed_count += len(batch)
+                batch = []
+        if batch:
+            Content.objects.bulk_update(batch, ['content_hash', 'filesize'])
+            hashed_count += len(batch)
+
+        self.stdout.write(f'Hashed {hashed_count} contents, {missing_count} files missing')
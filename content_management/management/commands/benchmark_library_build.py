@@ -0,0 +1,95 @@
+import os
+import shutil
+import sqlite3
+import time
+from contextlib import closing
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+
+from content_management.models import Content, LibraryFolder, LibraryVersion, Metadata, MetadataType
+from content_management.library_db_utils import query_plan_problems
+from content_management.utils import LibraryBuildUtil
+
+
+class Command(BaseCommand):
+    help = "Times library builds of a synthetic version, with and without bulk load mode, " \
+           "and checks that the device queries use indexes. The synthetic rows are rolled back afterwards"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--contents', type=int, default=100000)
+        parser.add_argument('--folders', type=int, default=500)
+        parser.add_argument('--metadata-per-content', type=int, default=3)
+        parser.add_argument('--runs', type=int, default=1, help="Builds to time in each mode")
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            start = time.perf_counter()
+            version = self.synthesize_version(options)
+            self.stdout.write(f'Synthesized {options["contents"]} contents in {time.perf_counter() - start:.1f}s')
+
+            build_util = LibraryBuildUtil()
+            for bulk_load in (False, True):
+                for run in range(options['runs']):
+                    start = time.perf_counter()
+                    build_util.build_library(version.id, f'benchmark{run}', bulk_load=bulk_load)
+                    self.stdout.write(f'bulk_load={bulk_load}: {time.perf_counter() - start:.2f}s')
+
+            database = build_util.library_db_path(version.id)
+            with closing(sqlite3.connect(database)) as conn:
+                problems = query_plan_problems(conn)
+            shutil.rmtree(os.path.dirname(database))
+            transaction.set_rollback(True)
+
+        if problems:
+            raise CommandError('Device queries without an index: ' +
+                               '; '.join(f'{name}: {detail}' for name, detail in problems))
+        self.stdout.write('All device queries use indexes')
+
+    def synthesize_version(self, options):
+        version = LibraryVersion.objects.create(library_name='Benchmark', version_number=f'benchmark-{time.time()}')
+
+        metadata_types = MetadataType.objects.bulk_create(
+            [MetadataType(name=f'Benchmark Type {time.time()} {i}') for i in range(4)])
+        version.metadata_types.add(*metadata_types)
+        metadata = Metadata.objects.bulk_create(
+            [Metadata(name=f'Benchmark {i}', type=metadata_types[i % len(metadata_types)]) for i in range(200)])
+
+        # a root with a few levels beneath it, each folder's parent created before it
+        folders = [LibraryFolder.objects.create(folder_name='Benchmark', version=version)]
+        while len(folders) < options['folders']:
+            parents = folders[-max(1, len(folders) // 2):]
+            level = LibraryFolder.objects.bulk_create([
+                LibraryFolder(folder_name=f'Folder {len(folders) + i}', version=version, parent=parent)
+                for i, parent in enumerate(parents[:options['folders'] - len(folders)])
+            ])
+            for folder in level:
+                folder.path = f'{folder.parent.path}{folder.id}/'
+                folder.origin_id = folder.id
+            LibraryFolder.objects.bulk_update(level, ['path', 'origin_id'])
+            folders.extend(level)
+
+        prefix = f'benchmark-{time.time()}'
+        contents = Content.objects.bulk_create([
+            Content(title=f'Benchmark Content {i}', description=f'Synthetic content number {i}',
+                    file_name=f'{prefix}-{i}.pdf', content_file=f'contents/{prefix}-{i}.pdf', filesize=1024 * i)
+            for i in range(options['contents'])
+        ], batch_size=5000)
+
+        ContentMetadata = Content.metadata.through
+        ContentMetadata.objects.bulk_create([
+            ContentMetadata(content_id=content.id, metadata_id=metadata[(i * 7 + j) % len(metadata)].id)
+            for i, content in enumerate(contents) for j in range(options['metadata_per_content'])
+        ], batch_size=5000)
+        FolderContent = LibraryFolder.library_content.through
+        FolderContent.objects.bulk_create([
+            FolderContent(libraryfolder_id=folders[i % len(folders)].id, content_id=content.id)
+            for i, content in enumerate(contents)
+        ], batch_size=5000)
+
+        # autovacuum never sees uncommitted rows, so give the planner the statistics a live catalog would have
+        with connection.cursor() as cursor:
+            for model in (Content, ContentMetadata, Metadata, MetadataType, LibraryVersion.metadata_types.through,
+                          LibraryFolder, FolderContent):
+                cursor.execute(f'ANALYZE {model._meta.db_table}')
+        return version
@@ -0,0 +1,28 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from content_management.jobs import fail_stale_jobs, run_next_job
+from content_management.utils import expire_upload_sessions
+
+
+class Command(BaseCommand):
+    help = "Runs queued import jobs and library builds, polling the database for new ones, " \
+           "fails jobs left running by a stopped worker and deletes abandoned upload sessions while idle"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help="Exit once the queue is empty")
+        parser.add_argument('--poll-interval', type=float, default=2.0, help="Seconds to wait when the queue is empty")
+
+    def handle(self, *args, **options):
+        fail_stale_jobs()
+        while True:
+            close_old_connections()
+            if run_next_job():
+                continue
+            fail_stale_jobs()
+            expire_upload_sessions()
+            if options['once']:
+                return
+            time.sleep(options['poll_interval'])
@@ -0,0 +1,18 @@
+# Generated by Django 3.0.4 on 2026-10-18 09:27
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('content_management', '0022_auto_20210416_1708'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='content',
+            name='content_hash',
+            field=models.CharField(db_index=True, max_length=64, null=True),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 3.0.4 on 2026-10-18 09:31
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('content_management', '0023_content_content_hash'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ImportJob',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('state', models.CharField(choices=[('queued', 'Queued'), ('running', 'Running'), ('finished', 'Finished'), ('failed', 'Failed')], db_index=True, default='queued', max_length=10)),
+                ('sheet_file', models.FileField(max_length=500, upload_to='imports/')),
+                ('content_path', models.CharField(max_length=500)),
+                ('created_on', models.DateTimeField(default=django.utils.timezone.now)),
+                ('started_on', models.DateTimeField(null=True)),
+                ('finished_on', models.DateTimeField(null=True)),
+                ('rows_done', models.PositiveIntegerField(default=0)),
+                ('rows_failed', models.PositiveIntegerField(default=0)),
+                ('unsuccessful_uploads', models.TextField(default='[]')),
+                ('error', models.TextField(null=True)),
+            ],
+            options={
+                'ordering': ['-pk'],
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.0.4 on 2026-10-18 09:32
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('content_management', '0024_importjob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='importjob',
+            name='sheet_format',
+            field=models.CharField(choices=[('json', 'JSON'), ('ndjson', 'Newline Delimited JSON'), ('csv', 'CSV')], default='json', max_length=10),
+        ),
+    ]
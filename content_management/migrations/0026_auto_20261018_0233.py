@@ -0,0 +1,18 @@
+# Generated by Django 3.0.4 on 2026-10-18 09:33
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('content_management', '0025_importjob_sheet_format'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='importjob',
+            name='sheet_format',
+            field=models.CharField(choices=[('json', 'JSON'), ('ndjson', 'Newline Delimited JSON'), ('csv', 'CSV'), ('xlsx', 'Excel Workbook')], default='json', max_length=10),
+        ),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 3.0.4 on 2026-10-18 09:34
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('content_management', '0026_auto_20261018_0233'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='importjob',
+            name='incremental',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='importjob',
+            name='rows_skipped',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.CreateModel(
+            name='ImportManifestEntry',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('source_path', models.CharField(max_length=1000, unique=True)),
+                ('size', models.BigIntegerField()),
+                ('mtime_ns', models.BigIntegerField()),
+                ('content_hash', models.CharField(max_length=64)),
+                ('imported_on', models.DateTimeField(default=django.utils.timezone.now)),
+                ('content', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='manifest_entries', to='content_management.Content')),
+            ],
+        ),
+    ]
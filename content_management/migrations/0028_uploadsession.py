@@ -0,0 +1,26 @@
+# Generated by Django 3.0.4 on 2026-10-18 09:36
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('content_management', '0027_auto_20261018_0234'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UploadSession',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('file_name', models.CharField(max_length=500)),
+                ('total_size', models.BigIntegerField()),
+                ('received', models.BigIntegerField(default=0)),
+                ('expected_hash', models.CharField(max_length=64, null=True)),
+                ('created_on', models.DateTimeField(default=django.utils.timezone.now)),
+                ('updated_on', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+        ),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 3.0.4 on 2026-10-18 09:37
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('content_management', '0028_uploadsession'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LibraryBuild',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('state', models.CharField(choices=[('queued', 'Queued'), ('running', 'Running'), ('finished', 'Finished'), ('failed', 'Failed')], db_index=True, default='queued', max_length=10)),
+                ('created_on', models.DateTimeField(default=django.utils.timezone.now)),
+                ('started_on', models.DateTimeField(null=True)),
+                ('finished_on', models.DateTimeField(null=True)),
+                ('error', models.TextField(null=True)),
+                ('stage', models.CharField(max_length=50, null=True)),
+                ('row_counts', models.TextField(default='{}')),
+                ('output_path', models.CharField(max_length=500, null=True)),
+                ('version', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='builds', to='content_management.LibraryVersion')),
+            ],
+            options={
+                'ordering': ['-pk'],
+                'abstract': False,
+            },
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 3.0.4 on 2026-10-18 10:17
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('content_management', '0029_librarybuild'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='librarybuild',
+            name='package',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='librarybuild',
+            name='package_path',
+            field=models.CharField(max_length=500, null=True),
+        ),
+    ]
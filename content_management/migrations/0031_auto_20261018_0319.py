@@ -0,0 +1,24 @@
+# Generated by Django 3.0.4 on 2026-10-18 10:19
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('content_management', '0030_auto_20261018_0317'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='librarybuild',
+            name='base_version',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='delta_builds', to='content_management.LibraryVersion'),
+        ),
+        migrations.AddField(
+            model_name='librarybuild',
+            name='delta_path',
+            field=models.CharField(max_length=500, null=True),
+        ),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 3.0.4 on 2026-10-18 10:25
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('content_management', '0031_auto_20261018_0319'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='libraryfolder',
+            name='path',
+            field=models.CharField(default='', editable=False, max_length=1000),
+        ),
+        migrations.AddIndex(
+            model_name='libraryfolder',
+            index=models.Index(fields=['path'], name='libraryfolder_path_idx', opclasses=['varchar_pattern_ops']),
+        ),
+        migrations.RunSQL(
+            """
+            WITH RECURSIVE tree (id, path) AS (
+                SELECT id, '/' || id || '/' FROM content_management_libraryfolder WHERE parent_id IS NULL
+              UNION ALL
+                SELECT child.id, tree.path || child.id || '/' FROM content_management_libraryfolder child
+                JOIN tree ON child.parent_id = tree.id
+            )
+            UPDATE content_management_libraryfolder SET path = tree.path FROM tree
+            WHERE content_management_libraryfolder.id = tree.id
+            """,
+            migrations.RunSQL.noop,
+        ),
+    ]
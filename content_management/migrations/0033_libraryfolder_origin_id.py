@@ -0,0 +1,22 @@
+# Generated by Django 3.0.4 on 2026-10-18 10:26
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('content_management', '0032_libraryfolder_path'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='libraryfolder',
+            name='origin_id',
+            field=models.IntegerField(db_index=True, editable=False, null=True),
+        ),
+        migrations.RunSQL(
+            "UPDATE content_management_libraryfolder SET origin_id = id",
+            migrations.RunSQL.noop,
+        ),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 3.0.4 on 2026-10-18 10:38
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('content_management', '0033_libraryfolder_origin_id'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='importjob',
+            name='updated_on',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.AddField(
+            model_name='librarybuild',
+            name='updated_on',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+    ]
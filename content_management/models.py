@@ -1,10 +1,15 @@
+import json
 import os
 from _datetime import datetime
 
-from django.db import models
+from django.db import models, transaction
+from django.db.models import Value
+from django.db.models.functions import Concat, Substr
 from django.dispatch import receiver
+from django.utils import timezone
 from django.utils.text import get_valid_filename
 
+from dlms import settings
 from content_management.validators import validate_unique_filename, validate_unique_file
 
 import logging
@@ -38,8 +43,21 @@ class Content(models.Model):
         if(self.content_file):
             self.filesize = self.content_file.size
             self.file_name = get_valid_filename(file_name)
+            # validate_unique_file already hashed uploads that went through validation
+            self.content_hash = getattr(self.content_file.file, 'content_hash', None) or self.compute_hash()
         return path
 
+    def compute_hash(self):
+        """
+        Returns the SHA-256 hex digest of content_file, leaving the file
+        positioned at its start so it can still be copied into storage
+        """
+        from content_management.utils import sha256
+        self.content_file.seek(0)
+        digest = sha256(self.content_file)
+        self.content_file.seek(0)
+        return digest
+
     content_file = models.FileField(
         "File",
         upload_to=set_file_name,
@@ -50,6 +68,7 @@ class Content(models.Model):
             ])
     filesize = models.FloatField(null=True, editable=True)
     file_name = models.CharField(max_length=500, null=True)
+    content_hash = models.CharField(max_length=64, null=True, db_index=True)
     title = models.CharField(max_length=300)
     description = models.TextField(null=True)
     modified_on = models.DateTimeField(default=datetime.now)
@@ -167,6 +186,53 @@ class LibraryFolder(models.Model):
     version = models.ForeignKey(LibraryVersion, related_name='folders', on_delete=models.CASCADE)
     parent = models.ForeignKey('self', on_delete=models.CASCADE, related_name="subfolders", null=True)
     library_content = models.ManyToManyField(Content, blank=True)
+    # ids from the top level folder down to this one, such as /12/40/41/, so a subtree is a prefix range
+    path = models.CharField(max_length=1000, default='', editable=False)
+    # id of the folder this one was first cloned from, or its own id, which matches a folder across versions
+    origin_id = models.IntegerField(null=True, db_index=True, editable=False)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['path'], name='libraryfolder_path_idx', opclasses=['varchar_pattern_ops']),
+        ]
+
+    def save(self, *args, **kwargs):
+        """
+        Saves the folder and keeps path and origin_id up to date.
+        When the folder was moved, the paths of all its subfolders are rewritten in one UPDATE.
+        Runs in a transaction, so a folder is never left saved without its path
+        """
+        old_path = self.path
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            parent_path = '/' if self.parent_id is None else \
+                LibraryFolder.objects.values_list('path', flat=True).get(id=self.parent_id)
+            path = f'{parent_path}{self.id}/'
+            if self.origin_id is None or path != old_path:
+                LibraryFolder.objects.filter(id=self.id).update(path=path, origin_id=self.origin_id or self.id)
+            if old_path and path != old_path:
+                LibraryFolder.objects.filter(version_id=self.version_id, path__startswith=old_path) \
+                    .exclude(id=self.id).update(path=Concat(Value(path), Substr('path', len(old_path) + 1)))
+        self.origin_id = self.origin_id or self.id
+        self.path = path
+
+    def subtree(self):
+        """
+        This folder and all of its subfolders
+        """
+        if not self.path:
+            # an empty prefix would match every folder
+            raise ValueError(f'LibraryFolder {self.id} has no path')
+        return LibraryFolder.objects.filter(version_id=self.version_id, path__startswith=self.path)
+
+    def ancestor_ids(self):
+        """
+        Ids of the folders above this one, from the top level folder down
+        """
+        return [int(folder_id) for folder_id in self.path.strip('/').split('/')[:-1]]
+
+    def depth(self):
+        return self.path.count('/') - 2
 
     def __str__(self):
         return f'{self.folder_name}'
@@ -178,3 +244,160 @@ def on_folder_save(sender, instance, *args, **kwargs):
             version_number=instance.version_number
     ).exists():
         return
+
+
+class Job(models.Model):
+    """
+    A unit of background work, claimed and run by the process_jobs worker
+    """
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    FINISHED = 'finished'
+    FAILED = 'failed'
+    STATES = (
+        (QUEUED, 'Queued'),
+        (RUNNING, 'Running'),
+        (FINISHED, 'Finished'),
+        (FAILED, 'Failed'),
+    )
+    state = models.CharField(max_length=10, choices=STATES, default=QUEUED, db_index=True)
+    created_on = models.DateTimeField(default=timezone.now)
+    started_on = models.DateTimeField(null=True)
+    # refreshed by the worker while the job runs, a running job that stops being refreshed lost its worker
+    updated_on = models.DateTimeField(default=timezone.now)
+    finished_on = models.DateTimeField(null=True)
+    error = models.TextField(null=True)
+
+    def duration(self):
+        """
+        Seconds the job has been running for, or ran for once finished
+        """
+        if self.started_on is None:
+            return None
+        return ((self.finished_on or timezone.now()) - self.started_on).total_seconds()
+
+    class Meta:
+        abstract = True
+        ordering = ['-pk']
+
+
+class ImportJob(Job):
+    FORMATS = (
+        ('json', 'JSON'),
+        ('ndjson', 'Newline Delimited JSON'),
+        ('csv', 'CSV'),
+        ('xlsx', 'Excel Workbook'),
+    )
+    sheet_file = models.FileField(upload_to="imports/", max_length=500)
+    sheet_format = models.CharField(max_length=10, choices=FORMATS, default='json')
+    content_path = models.CharField(max_length=500)
+    incremental = models.BooleanField(default=False)
+    rows_done = models.PositiveIntegerField(default=0)
+    rows_failed = models.PositiveIntegerField(default=0)
+    rows_skipped = models.PositiveIntegerField(default=0)
+    unsuccessful_uploads = models.TextField(default='[]')
+
+    def throughput(self):
+        """
+        Rows processed per second so far
+        """
+        elapsed = self.duration()
+        return self.rows_done / elapsed if elapsed else None
+
+    def result(self):
+        """
+        The same summary that a synchronous bulk add returns, once the job has finished
+        """
+        if self.state != ImportJob.FINISHED:
+            return None
+        result = {
+            'success_count': self.rows_done - self.rows_failed - self.rows_skipped,
+            'unsuccessful_uploads': json.loads(self.unsuccessful_uploads),
+        }
+        if self.incremental:
+            result['skipped_count'] = self.rows_skipped
+        return result
+
+    def __str__(self):
+        return f'ImportJob<{self.id}, {self.state}>'
+
+@receiver(models.signals.post_delete, sender=ImportJob)
+def on_import_job_delete(sender, instance, **kwargs):
+    if instance.sheet_file:
+        if os.path.isfile(instance.sheet_file.path):
+            os.remove(instance.sheet_file.path)
+
+
+class ImportManifestEntry(models.Model):
+    """
+    A file that was imported by a bulk add, used by incremental imports to
+    skip files that have not changed since
+    """
+    source_path = models.CharField(max_length=1000, unique=True)
+    size = models.BigIntegerField()
+    mtime_ns = models.BigIntegerField()
+    content_hash = models.CharField(max_length=64)
+    content = models.ForeignKey(Content, related_name="manifest_entries", on_delete=models.CASCADE)
+    imported_on = models.DateTimeField(default=timezone.now)
+
+    def __str__(self):
+        return f'{self.source_path}'
+
+
+class UploadSession(models.Model):
+    """
+    A content file being uploaded in chunks, assembled in a partial file in CONTENTS_ROOT
+    """
+    file_name = models.CharField(max_length=500)
+    total_size = models.BigIntegerField()
+    received = models.BigIntegerField(default=0)
+    expected_hash = models.CharField(max_length=64, null=True)
+    created_on = models.DateTimeField(default=timezone.now)
+    updated_on = models.DateTimeField(default=timezone.now)
+
+    def part_path(self):
+        return os.path.join(settings.CONTENTS_ROOT, f'.upload-{self.id}.part')
+
+    def __str__(self):
+        return f'UploadSession<{self.file_name}, {self.received}/{self.total_size}>'
+
+@receiver(models.signals.post_delete, sender=UploadSession)
+def on_upload_session_delete(sender, instance, **kwargs):
+    if os.path.isfile(instance.part_path()):
+        os.remove(instance.part_path())
+
+
+class LibraryBuild(Job):
+    """
+    A build of a library version's SQLite database, run by the process_jobs worker
+    When package is set, the build also stages the full deployable tree of the version,
+    and when base_version is set, an update package from that version
+    """
+    version = models.ForeignKey(LibraryVersion, related_name="builds", on_delete=models.CASCADE)
+    package = models.BooleanField(default=False)
+    base_version = models.ForeignKey(LibraryVersion, related_name="delta_builds", on_delete=models.SET_NULL, null=True)
+    stage = models.CharField(max_length=50, null=True)
+    row_counts = models.TextField(default='{}')
+    output_path = models.CharField(max_length=500, null=True)
+    package_path = models.CharField(max_length=500, null=True)
+    delta_path = models.CharField(max_length=500, null=True)
+
+    def rows_written(self):
+        """
+        Rows written so far to each table of the library database
+        """
+        return json.loads(self.row_counts)
+
+    def superseded_by(self, **outputs):
+        """
+        Later builds of the same version write to the same paths, so a build's files are only its own
+        until another build of the version finishes
+        :param outputs: filters for builds that wrote the output in question, such as package=True
+        :return: the latest build that replaced this build's output, or None
+        """
+        return LibraryBuild.objects.filter(version_id=self.version_id, state=self.FINISHED,
+                                           finished_on__gt=self.finished_on, **outputs) \
+            .order_by('-finished_on').first()
+
+    def __str__(self):
+        return f'LibraryBuild<{self.version_id}, {self.state}>'
@@ -1,8 +1,11 @@
-from rest_framework.serializers import ModelSerializer
+from django.core.files import File
+from django.utils.text import get_valid_filename
+from rest_framework.serializers import ModelSerializer, ValidationError
 from content_management.models import (
     Content, Metadata, MetadataType, User,
-    LibraryVersion, LibraryFolder, LibLayoutImage, LibraryModule)
+    LibraryVersion, LibraryFolder, LibLayoutImage, LibraryModule, ImportJob, UploadSession, LibraryBuild)
 from rest_framework.validators import UniqueTogetherValidator
+from content_management.validators import validate_unique_filename, validate_unique_hash
 
 
 class ContentSerializer(ModelSerializer):
@@ -13,6 +16,14 @@ class ContentSerializer(ModelSerializer):
                   "published_year", "filesize", "reviewed_on", 'duplicatable')
 
 
+class UploadedContentSerializer(ContentSerializer):
+    """
+    Content fields sent when finalizing a chunked upload, the file itself comes from the upload session
+    """
+    class Meta(ContentSerializer.Meta):
+        read_only_fields = ('content_file', 'file_name', 'filesize')
+
+
 class MetadataSerializer(ModelSerializer):
     class Meta:
         validators = [
@@ -51,6 +62,13 @@ class LibraryFolderSerializer(ModelSerializer):
         model = LibraryFolder
         fields = '__all__'
 
+    def validate(self, data):
+        parent = data.get('parent')
+        # paths list every ancestor id, so this also holds for a folder whose own path was never filled in
+        if self.instance is not None and parent is not None and f'/{self.instance.id}/' in parent.path:
+            raise ValidationError('A folder cannot be moved into itself or one of its subfolders')
+        return data
+
 
 class UserSerializer(ModelSerializer):
     class Meta:
@@ -62,3 +80,47 @@ class LibraryModuleSerializer(ModelSerializer):
     class Meta:
         model = LibraryModule
         fields = ("id", "module_name", "module_file", "logo_img", "file_name")
+
+
+class ImportJobSerializer(ModelSerializer):
+    class Meta:
+        model = ImportJob
+        fields = ("id", "state", "sheet_format", "content_path", "incremental", "created_on", "started_on",
+                  "updated_on", "finished_on", "rows_done", "rows_failed", "rows_skipped", "throughput", "result", "error")
+
+
+class LibraryBuildSerializer(ModelSerializer):
+    class Meta:
+        model = LibraryBuild
+        fields = ("id", "version", "package", "base_version", "state", "stage", "created_on", "started_on",
+                  "updated_on", "finished_on", "duration", "rows_written", "error")
+        read_only_fields = ("state", "stage", "created_on", "started_on", "updated_on", "finished_on", "error")
+
+    def validate(self, data):
+        if data.get('base_version') is not None and data['base_version'] == data['version']:
+            raise ValidationError('base_version must differ from version')
+        return data
+
+
+class UploadSessionSerializer(ModelSerializer):
+    class Meta:
+        model = UploadSession
+        fields = ("id", "file_name", "total_size", "received", "expected_hash", "created_on", "updated_on")
+        read_only_fields = ("received", "created_on", "updated_on")
+
+    def validate_file_name(self, value):
+        value = get_valid_filename(value)
+        validate_unique_filename(File(None, value))
+        return value
+
+    def validate_total_size(self, value):
+        if value < 0:
+            raise ValidationError('total_size must not be negative')
+        return value
+
+    def validate_expected_hash(self, value):
+        # lets clients skip uploading a file the library already has
+        if value is not None:
+            value = value.lower()
+            validate_unique_hash(value)
+        return value
@@ -0,0 +1,127 @@
+import csv
+import io
+import json
+import re
+
+from openpyxl import load_workbook
+
+# characters read from a sheet at a time
+READ_SIZE = 64 * 1024
+# whitespace allowed between JSON values
+WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+
+def iter_json_rows(stream):
+    """
+    Yields the objects of a JSON array one at a time, reading the stream
+    incrementally instead of decoding the whole array at once
+    :param stream: text stream containing a JSON array of sheet rows
+    """
+    decoder = json.JSONDecoder()
+    buffer = ""
+    # where the unparsed part of buffer starts, rows are decoded in place instead of slicing them off the buffer
+    position = 0
+    eof = False
+
+    def read_more():
+        nonlocal buffer, position, eof
+        if eof:
+            raise ValueError("Sheet data ended unexpectedly")
+        chunk = stream.read(READ_SIZE)
+        eof = chunk == ""
+        # the parsed part is only dropped here, once per chunk read
+        buffer = buffer[position:] + chunk
+        position = 0
+
+    # start: before '[', first: before the first row, value: before a row, separator: after a row
+    state = "start"
+    while True:
+        position = WHITESPACE.match(buffer, position).end()
+        if position == len(buffer):
+            read_more()
+        elif state == "start":
+            if buffer[position] != "[":
+                raise ValueError("Sheet data must be a JSON array")
+            position += 1
+            state = "first"
+        elif state in ("first", "separator") and buffer[position] == "]":
+            return
+        elif state == "separator":
+            if buffer[position] != ",":
+                raise ValueError("Expected ',' between sheet rows")
+            position += 1
+            state = "value"
+        else:
+            try:
+                row, position = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+                # the row continues past the end of the buffer
+                read_more()
+                continue
+            state = "separator"
+            yield row
+
+
+def iter_ndjson_rows(stream):
+    """
+    Yields one sheet row per non-blank line of newline delimited JSON
+    """
+    for line in stream:
+        if line.strip():
+            yield json.loads(line)
+
+
+def iter_csv_rows(stream):
+    """
+    Yields one sheet row per CSV record, keyed by the header row
+    """
+    yield from csv.DictReader(stream)
+
+
+def iter_xlsx_rows(sheet_file):
+    """
+    Yields one sheet row per row of the first worksheet, keyed by the header row
+    The workbook is opened in read-only mode, which parses the worksheet as it
+    is iterated instead of loading the whole workbook. Like the frontend's
+    sheet_to_json, empty cells become '' and blank rows are skipped.
+    Numbers and dates become strings, as every cell of a CSV sheet is.
+    :param sheet_file: binary file containing the workbook
+    """
+    workbook = load_workbook(sheet_file, read_only=True, data_only=True)
+    try:
+        rows = workbook.worksheets[0].iter_rows(values_only=True)
+        header = next(rows, None)
+        if header is None:
+            return
+        columns = [(index, str(name).strip()) for index, name in enumerate(header) if name is not None]
+        for values in rows:
+            if all(value is None or value == '' for value in values):
+                continue
+            yield {
+                name: str(values[index]) if index < len(values) and values[index] is not None else ''
+                for index, name in columns
+            }
+    finally:
+        workbook.close()
+
+
+SHEET_READERS = {
+    "json": iter_json_rows,
+    "ndjson": iter_ndjson_rows,
+    "csv": iter_csv_rows,
+}
+
+
+def read_sheet_rows(sheet_file, sheet_format):
+    """
+    :param sheet_file: binary file containing the sheet
+    :param sheet_format: "xlsx" or one of the keys of SHEET_READERS
+    :return: generator of sheet rows
+    """
+    if sheet_format == "xlsx":
+        return iter_xlsx_rows(sheet_file)
+    # utf-8-sig drops the byte order mark spreadsheet programs put in front of CSV exports
+    stream = io.TextIOWrapper(sheet_file, encoding="utf-8-sig", newline="")
+    return SHEET_READERS[sheet_format](stream)
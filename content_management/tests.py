@@ -1,3 +1,946 @@
-from django.test import TestCase
+import datetime
+import errno
+import hashlib
+import io
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+from contextlib import closing
+from unittest import mock
 
-# Create your tests here.
+from django.contrib.auth.models import User as AuthUser
+from django.core.exceptions import ValidationError
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import connection
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from dlms import settings
+from content_management import jobs, utils, views
+from content_management.library_db_utils import LibraryDbUtil, SEARCH_QUERY, TABLE_KEYS, query_plan_problems
+from content_management.models import (
+    Content, ImportJob, LibraryBuild, LibraryFolder, LibraryModule, LibraryVersion, Metadata, MetadataType,
+    UploadSession)
+from content_management.sheet_readers import read_sheet_rows
+from content_management.utils import (
+    UNCHANGED, ContentSheetUtil, ImportManifest, MetadataResolver, commit_staged_file, expire_upload_sessions,
+    link_file, sha256, stage_content_file)
+from content_management.validators import validate_unique_hash
+
+
+def admin_client():
+    client = APIClient()
+    client.force_authenticate(AuthUser.objects.create(username='admin', is_staff=True))
+    return client
+
+
+def make_library(version_number, content_count=12):
+    """
+    Creates a version with the folders Root, Root/A, Root/A/A1 and Root/B, contents tagged with two metadata each,
+    and two contents placed in more than one folder
+    :return: the version and a dict of its folders by name
+    """
+    subject = MetadataType.objects.get_or_create(name='Subject')[0]
+    language = MetadataType.objects.get_or_create(name='Language')[0]
+    metadata = [Metadata.objects.get_or_create(name=f'Subject {i}', type=subject)[0] for i in range(3)] + \
+               [Metadata.objects.get_or_create(name=f'Language {i}', type=language)[0] for i in range(2)]
+    contents = Content.objects.bulk_create([
+        Content(title=f'{version_number} {i}', file_name=f'{version_number}-{i}.pdf', filesize=100 + i,
+                content_file=f'contents/{version_number}-{i}.pdf')
+        for i in range(content_count)
+    ])
+    Content.metadata.through.objects.bulk_create([
+        Content.metadata.through(content_id=content.id, metadata_id=metadata_id)
+        for i, content in enumerate(contents) for metadata_id in (metadata[i % 3].id, metadata[3 + i % 2].id)
+    ])
+    version = LibraryVersion.objects.create(library_name='Library', version_number=version_number)
+    version.metadata_types.add(subject, language)
+    version.library_modules.add(LibraryModule.objects.create(module_name=f'{version_number} module'))
+    folders = {'Root': LibraryFolder.objects.create(version=version, folder_name='Root')}
+    for name, parent in (('A', 'Root'), ('B', 'Root'), ('A1', 'A')):
+        folders[name] = LibraryFolder.objects.create(version=version, folder_name=name, parent=folders[parent])
+    quarter = content_count // 4
+    folders['Root'].library_content.set(contents[:quarter])
+    folders['A'].library_content.set(contents[quarter:2 * quarter])
+    folders['B'].library_content.set(contents[2 * quarter:3 * quarter] + contents[:1])
+    folders['A1'].library_content.set(contents[3 * quarter:] + contents[quarter:quarter + 1])
+    return version, folders
+
+
+class ContentsRootMixin:
+    """
+    Points MEDIA_ROOT and CONTENTS_ROOT at a temporary folder for the duration of each test
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root)
+        self.contents_root = os.path.join(self.media_root, 'contents')
+        os.mkdir(self.contents_root)
+        media_settings = override_settings(MEDIA_ROOT=self.media_root)
+        media_settings.enable()
+        self.addCleanup(media_settings.disable)
+        patcher = mock.patch.object(settings, 'CONTENTS_ROOT', self.contents_root)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def source_file(self, name, data, folder=None):
+        if folder is None:
+            folder = tempfile.mkdtemp()
+            self.addCleanup(shutil.rmtree, folder)
+        path = os.path.join(folder, name)
+        with open(path, 'wb') as source:
+            source.write(data)
+        return path
+
+
+class CommitStagedFileTests(ContentsRootMixin, TestCase):
+
+    def test_commit_moves_file_into_place(self):
+        staged = stage_content_file(self.source_file('book.pdf', b'first'))
+        content = Content()
+        commit_staged_file(staged, content)
+        self.assertEqual(content.file_name, 'book.pdf')
+        self.assertEqual(content.filesize, 5)
+        with open(os.path.join(self.contents_root, 'book.pdf'), 'rb') as committed:
+            self.assertEqual(committed.read(), b'first')
+        self.assertFalse(os.path.exists(staged.temp_path))
+
+    def test_commit_never_overwrites_a_file_committed_since_the_name_check(self):
+        first = stage_content_file(self.source_file('book.pdf', b'first'))
+        second = stage_content_file(self.source_file('book.pdf', b'second'))
+        commit_staged_file(first, Content())
+        # both imports passed the name check before either file was in place
+        with mock.patch('content_management.utils.validate_unique_filename'):
+            with self.assertRaisesMessage(ValidationError, 'Filename already exists.'):
+                commit_staged_file(second, Content())
+        with open(os.path.join(self.contents_root, 'book.pdf'), 'rb') as committed:
+            self.assertEqual(committed.read(), b'first')
+        self.assertFalse(os.path.exists(second.temp_path))
+
+
+class ContentHashTests(ContentsRootMixin, TestCase):
+
+    def test_upload_is_hashed_once(self):
+        with mock.patch('content_management.utils.sha256', wraps=sha256) as hasher:
+            response = admin_client().post('/api/contents/', {
+                'title': 'Solar Power',
+                'content_file': SimpleUploadedFile('solar.pdf', b'solar'),
+            }, format='multipart')
+        self.assertEqual(response.status_code, 201, response.data)
+        self.assertEqual(hasher.call_count, 1)
+        content = Content.objects.get(title='Solar Power')
+        self.assertEqual(content.content_hash, hashlib.sha256(b'solar').hexdigest())
+
+    def test_validate_unique_hash(self):
+        content_hash = hashlib.sha256(b'solar').hexdigest()
+        validate_unique_hash(content_hash)
+        Content.objects.create(title='Solar Power', file_name='solar.pdf', content_hash=content_hash)
+        with self.assertRaisesMessage(ValidationError, 'File already exists with name solar.pdf'):
+            validate_unique_hash(content_hash)
+
+    def test_backfill_content_hashes(self):
+        for name in ('hashed.pdf', 'unhashed.pdf'):
+            self.source_file(name, name.encode(), folder=self.contents_root)
+        hashed = Content.objects.create(
+            title='Hashed', content_file='contents/hashed.pdf', content_hash='0' * 64, filesize=1)
+        unhashed = Content.objects.create(title='Unhashed', content_file='contents/unhashed.pdf')
+        missing = Content.objects.create(title='Missing', content_file='contents/missing.pdf')
+        stdout, stderr = io.StringIO(), io.StringIO()
+        call_command('backfill_content_hashes', stdout=stdout, stderr=stderr)
+        self.assertIn('Hashed 1 contents, 1 files missing', stdout.getvalue())
+        self.assertIn(f'Missing file for content {missing.id}', stderr.getvalue())
+        unhashed.refresh_from_db()
+        self.assertEqual(unhashed.content_hash, hashlib.sha256(b'unhashed.pdf').hexdigest())
+        self.assertEqual(unhashed.filesize, len(b'unhashed.pdf'))
+        hashed.refresh_from_db()
+        self.assertEqual(hashed.content_hash, '0' * 64)
+        missing.refresh_from_db()
+        self.assertIsNone(missing.content_hash)
+
+        call_command('backfill_content_hashes', '--all', stdout=stdout, stderr=stderr)
+        hashed.refresh_from_db()
+        self.assertEqual(hashed.content_hash, hashlib.sha256(b'hashed.pdf').hexdigest())
+
+
+class UploadChunkTests(ContentsRootMixin, TransactionTestCase):
+
+    def test_concurrent_chunks_at_the_same_offset_are_written_once(self):
+        session = UploadSession.objects.create(file_name='big.bin', total_size=8)
+        client = admin_client()
+        writing = threading.Event()
+        release = threading.Event()
+        append_upload_chunk = views.append_upload_chunk
+
+        def slow_append(*args):
+            writing.set()
+            release.wait(5)
+            append_upload_chunk(*args)
+
+        responses = []
+
+        def put_chunk():
+            try:
+                responses.append(client.put(f'/api/upload_sessions/{session.id}/chunk/?offset=0', b'abcd',
+                                            content_type='application/octet-stream'))
+            finally:
+                connection.close()
+
+        with mock.patch.object(views, 'append_upload_chunk', slow_append):
+            first = threading.Thread(target=put_chunk)
+            first.start()
+            self.assertTrue(writing.wait(5))
+            # the retry waits on the session row while the first chunk is still being written
+            retry = threading.Thread(target=put_chunk)
+            retry.start()
+            retry.join(0.5)
+            self.assertTrue(retry.is_alive())
+            release.set()
+            first.join(5)
+            retry.join(5)
+
+        self.assertEqual(sorted(response.status_code for response in responses), [200, 409])
+        session.refresh_from_db()
+        self.assertEqual(session.received, 4)
+        with open(session.part_path(), 'rb') as part:
+            self.assertEqual(part.read(), b'abcd')
+
+
+class UploadFinalizeTests(ContentsRootMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.client = admin_client()
+
+    def upload(self, data):
+        session = UploadSession.objects.create(file_name='notes.txt', total_size=len(data))
+        if data:
+            response = self.client.put(f'/api/upload_sessions/{session.id}/chunk/?offset=0', data,
+                                       content_type='application/octet-stream')
+            self.assertEqual(response.status_code, 200)
+        return session
+
+    def finalize(self, session):
+        return self.client.post(f'/api/upload_sessions/{session.id}/finalize/', {'title': 'Notes'}, format='json')
+
+    def test_finalize_creates_content_from_the_uploaded_bytes(self):
+        response = self.finalize(self.upload(b'some notes'))
+        self.assertEqual(response.status_code, 201)
+        content = Content.objects.get(id=response.json()['data']['id'])
+        self.assertEqual(content.filesize, 10)
+        with open(os.path.join(self.contents_root, 'notes.txt'), 'rb') as committed:
+            self.assertEqual(committed.read(), b'some notes')
+        self.assertFalse(UploadSession.objects.exists())
+
+    def test_finalize_of_an_empty_file(self):
+        response = self.finalize(self.upload(b''))
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(Content.objects.get().filesize, 0)
+
+    def test_finalize_fails_when_the_partial_file_is_gone(self):
+        session = self.upload(b'some notes')
+        os.remove(session.part_path())
+        response = self.finalize(session)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()['error'], ['Upload data lost, start a new upload session'])
+        self.assertFalse(Content.objects.exists())
+
+    def test_failed_save_keeps_the_upload_for_another_finalize(self):
+        session = self.upload(b'some notes')
+        with mock.patch('content_management.serializers.UploadedContentSerializer.save', side_effect=RuntimeError):
+            with self.assertRaises(RuntimeError):
+                self.finalize(session)
+        self.assertFalse(os.path.exists(os.path.join(self.contents_root, 'notes.txt')))
+        response = self.finalize(session)
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(Content.objects.get().filesize, 10)
+
+    def test_abandoned_sessions_expire(self):
+        abandoned = self.upload(b'abandoned')
+        UploadSession.objects.filter(id=abandoned.id).update(updated_on=timezone.now() - datetime.timedelta(days=2))
+        active = self.upload(b'active')
+        self.assertEqual(expire_upload_sessions(), 1)
+        self.assertFalse(os.path.exists(abandoned.part_path()))
+        self.assertEqual(list(UploadSession.objects.values_list('id', flat=True)), [active.id])
+
+
+class LibraryFolderTests(TestCase):
+
+    def setUp(self):
+        self.client = admin_client()
+        self.version = LibraryVersion.objects.create(library_name='Library', version_number='1')
+        self.root = LibraryFolder.objects.create(version=self.version, folder_name='Root')
+        self.child = LibraryFolder.objects.create(version=self.version, folder_name='Child', parent=self.root)
+        self.leaf = LibraryFolder.objects.create(version=self.version, folder_name='Leaf', parent=self.child)
+        self.other = LibraryFolder.objects.create(version=self.version, folder_name='Other')
+
+    def test_paths_follow_moves(self):
+        self.assertEqual(self.leaf.path, f'/{self.root.id}/{self.child.id}/{self.leaf.id}/')
+        self.child.parent = self.other
+        self.child.save()
+        self.leaf.refresh_from_db()
+        self.assertEqual(self.leaf.path, f'/{self.other.id}/{self.child.id}/{self.leaf.id}/')
+        self.assertEqual(self.leaf.ancestor_ids(), [self.other.id, self.child.id])
+
+    def test_delete_removes_the_subtree_only(self):
+        response = self.client.delete(f'/api/library_folders/{self.root.id}/')
+        self.assertEqual(response.status_code, 204)
+        self.assertEqual(list(LibraryFolder.objects.values_list('id', flat=True)), [self.other.id])
+
+    def test_delete_of_a_folder_without_path_keeps_other_folders(self):
+        LibraryFolder.objects.filter(id=self.child.id).update(path='')
+        other_version = LibraryVersion.objects.create(library_name='Library', version_number='2')
+        kept = LibraryFolder.objects.create(version=other_version, folder_name='Root')
+        response = self.client.delete(f'/api/library_folders/{self.child.id}/')
+        self.assertEqual(response.status_code, 204)
+        self.assertEqual(set(LibraryFolder.objects.values_list('id', flat=True)), {self.root.id, self.other.id, kept.id})
+
+    def test_folder_cannot_move_into_its_subtree(self):
+        for parent in (self.root, self.leaf):
+            response = self.client.patch(f'/api/library_folders/{self.root.id}/', {'parent': parent.id})
+            self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.client.patch(f'/api/library_folders/{self.child.id}/', {'parent': self.other.id})
+                         .status_code, 200)
+
+    def test_folder_without_path_can_move(self):
+        LibraryFolder.objects.filter(id=self.other.id).update(path='')
+        response = self.client.patch(f'/api/library_folders/{self.other.id}/', {'parent': self.leaf.id})
+        self.assertEqual(response.status_code, 200)
+        self.other.refresh_from_db()
+        self.assertEqual(self.other.path, f'{self.leaf.path}{self.other.id}/')
+
+
+class LibraryDbTests(SimpleTestCase):
+
+    def build(self, bulk_load):
+        folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, folder)
+        contents = [(i, f'Title {i}', 'About solar power', f'file{i}.pdf', '2020-01-01', None, None, 100.0)
+                    for i in range(1, 51)]
+        return LibraryDbUtil(
+            metadata_types=[(1, 'Subject')],
+            metadata=[(1, 'Solar', 'Subject', 1), (2, 'Water', 'Subject', 1)],
+            folders=[(1, 'Root', None, None), (2, 'Child', None, 1)],
+            modules=[(1, 'Module', None)],
+            contents=contents,
+            contents_metadata=[(content[0], 1 + content[0] % 2) for content in contents],
+            contents_folder=[(content[0], 1 + content[0] % 2, content[1], content[7]) for content in contents],
+            folder_stats=[(1, 50, 5000.0), (2, 25, 2500.0)],
+            metadata_stats=[(1, 25), (2, 25)],
+            bulk_load=bulk_load
+        ).create_library_db(os.path.join(folder, 'solarspell.db'))
+
+    def test_device_queries_use_indexes(self):
+        for bulk_load in (False, True):
+            with self.subTest(bulk_load=bulk_load), closing(sqlite3.connect(self.build(bulk_load))) as conn:
+                self.assertEqual(query_plan_problems(conn), [])
+
+    def test_search_matches_metadata(self):
+        with closing(sqlite3.connect(self.build(True))) as conn:
+            self.assertEqual(len(conn.execute(SEARCH_QUERY, ('water', 100)).fetchall()), 25)
+
+
+class QueryCountTests(TestCase):
+    """
+    List endpoints make a fixed number of queries, whatever the number of rows they return
+    """
+
+    def setUp(self):
+        self.client = admin_client()
+        self.version, self.folders = make_library('1', content_count=40)
+        make_library('2', content_count=40)
+
+    def get(self, url):
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return response.json()['data']
+
+    def test_content_list(self):
+        # count, page, metadata and metadata types
+        for size in (5, 50):
+            with self.subTest(size=size), self.assertNumQueries(4):
+                data = self.get(f'/api/contents/?size={size}')
+            self.assertEqual(len(data['results']), size)
+            self.assertTrue(all(len(content['metadata_info']) == 2 for content in data['results']))
+
+    def test_version_list(self):
+        # count, page with creators, modules and metadata types
+        with self.assertNumQueries(4):
+            data = self.get('/api/library_versions/')
+        self.assertEqual([len(version['library_modules']) for version in data['results']], [1, 1])
+
+    def test_folder_contents(self):
+        # subfolders, their contents, the folder's contents, metadata and metadata types
+        with self.assertNumQueries(5):
+            data = self.get(f'/api/library_folders/{self.folders["Root"].id}/contents/')
+        self.assertEqual([folder['folder_name'] for folder in data['folders']], ['A', 'B'])
+        self.assertEqual(len(data['files']), 10)
+        self.assertTrue(all(len(content['metadata_info']) == 2 for content in data['files']))
+        # a folder without subfolders has nothing to prefetch for them
+        with self.assertNumQueries(4):
+            data = self.get(f'/api/library_folders/{self.folders["A1"].id}/contents/')
+        self.assertEqual(len(data['files']), 11)
+
+    def test_add_content(self):
+        # folder, folder and content validation, and the insert in a savepoint
+        content_ids = list(Content.objects.values_list('id', flat=True)[:20])
+        with self.assertNumQueries(6):
+            response = self.client.post(f'/api/library_folders/{self.folders["B"].id}/addcontent/',
+                                        {'content_ids': content_ids}, format='json')
+        self.assertEqual(response.status_code, 200)
+
+
+class JobTests(TransactionTestCase):
+
+    def test_stale_running_jobs_fail(self):
+        long_ago = timezone.now() - datetime.timedelta(minutes=settings.JOB_STALE_MINUTES + 1)
+        stale = ImportJob.objects.create(content_path='/', state=ImportJob.RUNNING, updated_on=long_ago)
+        running = ImportJob.objects.create(content_path='/', state=ImportJob.RUNNING)
+        queued = ImportJob.objects.create(content_path='/', updated_on=long_ago)
+        version = LibraryVersion.objects.create(library_name='Library', version_number='1')
+        stale_build = LibraryBuild.objects.create(version=version, state=LibraryBuild.RUNNING, updated_on=long_ago)
+
+        self.assertEqual(jobs.fail_stale_jobs(), 2)
+        states = dict(ImportJob.objects.values_list('id', 'state'))
+        self.assertEqual(states, {stale.id: ImportJob.FAILED, running.id: ImportJob.RUNNING,
+                                  queued.id: ImportJob.QUEUED})
+        stale_build.refresh_from_db()
+        self.assertEqual(stale_build.state, LibraryBuild.FAILED)
+        self.assertIsNotNone(stale_build.error)
+
+    def test_running_jobs_are_kept_fresh(self):
+        ImportJob.objects.create(content_path='/')
+        job = jobs.claim_next_job(ImportJob)
+        claimed_on = job.updated_on
+        with mock.patch.object(jobs, 'HEARTBEAT_INTERVAL', 0.05):
+            jobs.run_with_heartbeat(job, lambda job: time.sleep(0.3))
+        job.refresh_from_db()
+        self.assertGreater(job.updated_on, claimed_on)
+
+
+class LibraryBuildDownloadTests(ContentsRootMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        builds_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, builds_root)
+        patcher = mock.patch.object(settings, 'BUILDS_ROOT', builds_root)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.client = admin_client()
+        self.version, folders = make_library('1')
+        self.write_content_files()
+
+    def write_content_files(self):
+        for content in Content.objects.all():
+            with open(os.path.join(self.contents_root, content.file_name), 'wb') as content_file:
+                content_file.write(content.title.encode())
+
+    def build(self, version=None, **fields):
+        build = LibraryBuild.objects.create(version=version or self.version, **fields)
+        self.assertTrue(jobs.run_next_job())
+        build.refresh_from_db()
+        self.assertEqual(build.state, LibraryBuild.FINISHED, build.error)
+        return build
+
+    def test_outputs_replaced_by_a_later_build_are_gone(self):
+        first = self.build(package=True)
+        second = self.build()
+        response = self.client.get(f'/api/library_builds/{first.id}/download/')
+        self.assertEqual(response.status_code, 410)
+        self.assertEqual(response.json()['data'], {'superseded_by': second.id})
+        self.assertEqual(self.client.get(f'/api/library_builds/{second.id}/download/').status_code, 200)
+        # the second build wrote no package, so the first build's package is still its own
+        self.assertEqual(self.client.get(f'/api/library_builds/{first.id}/package/').status_code, 200)
+        third = self.build(package=True)
+        response = self.client.get(f'/api/library_builds/{first.id}/package/')
+        self.assertEqual(response.status_code, 410)
+        self.assertEqual(response.json()['data'], {'superseded_by': third.id})
+
+    def next_version(self):
+        """
+        Clones the version and changes it: one content is added, one is dropped from a folder and one is retitled
+        """
+        version = self.client.get(f'/api/library_versions/{self.version.id}/clone/').json()['data']
+        folders = {folder.folder_name: folder for folder in LibraryFolder.objects.filter(version_id=version['id'])}
+        added = Content.objects.create(title='Added', file_name='added.pdf', content_file='contents/added.pdf')
+        self.source_file('added.pdf', b'added', folder=self.contents_root)
+        folders['B'].library_content.add(added)
+        folders['A1'].library_content.remove(folders['A1'].library_content.first())
+        Content.objects.filter(id=folders['Root'].library_content.first().id).update(title='Retitled')
+        return LibraryVersion.objects.get(id=version['id'])
+
+    def test_delta_patch_turns_the_base_database_into_the_new_one(self):
+        base = self.build()
+        version = self.next_version()
+        build = self.build(version, base_version=self.version)
+
+        patched = os.path.join(tempfile.mkdtemp(dir=settings.BUILDS_ROOT), 'solarspell.db')
+        shutil.copyfile(base.output_path, patched)
+        with open(os.path.join(build.delta_path, 'patch.sql')) as patch_file, \
+                closing(sqlite3.connect(patched)) as conn:
+            conn.executescript(patch_file.read())
+        with closing(sqlite3.connect(build.output_path)) as conn:
+            conn.execute('ATTACH DATABASE ? AS patched', (patched,))
+            for table, keys in TABLE_KEYS:
+                for first, second in (('main', 'patched'), ('patched', 'main')):
+                    self.assertEqual(conn.execute(f'SELECT * FROM {first}.{table} '
+                                                  f'EXCEPT SELECT * FROM {second}.{table}').fetchall(), [], table)
+        for database in (build.output_path, patched):
+            with closing(sqlite3.connect(database)) as conn:
+                self.assertEqual(len(conn.execute(SEARCH_QUERY, ('retitled', 100)).fetchall()), 1)
+
+        with open(os.path.join(build.delta_path, 'delta.json')) as summary_file:
+            summary = json.load(summary_file)
+        self.assertEqual(summary['added_files'], 1)
+        self.assertTrue(os.path.isfile(os.path.join(build.delta_path, 'files', 'contents', 'added.pdf')))
+
+    def test_delta_replaced_by_a_later_delta_from_the_same_base_is_gone(self):
+        version = self.next_version()
+        other_base, _ = make_library('0')
+        self.write_content_files()
+        first = self.build(version, base_version=self.version)
+        self.build(version)
+        self.build(version, base_version=other_base)
+        # neither later build rewrote the delta from self.version
+        self.assertEqual(self.client.get(f'/api/library_builds/{first.id}/delta/').status_code, 200)
+        latest = self.build(version, base_version=self.version)
+        response = self.client.get(f'/api/library_builds/{first.id}/delta/')
+        self.assertEqual(response.status_code, 410)
+        self.assertEqual(response.json()['data'], {'superseded_by': latest.id})
+        self.assertEqual(self.client.get(f'/api/library_builds/{latest.id}/delta/').status_code, 200)
+
+
+class ImportChunkTests(ContentsRootMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.source_folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.source_folder)
+        MetadataType.objects.create(name='Subject')
+
+    def rows(self, prefix, count):
+        rows = []
+        for i in range(count):
+            self.source_file(f'{prefix}{i}.pdf', f'{prefix} {i}'.encode(), self.source_folder)
+            rows.append({'File Name': f'{prefix}{i}.pdf', 'Title': f'{prefix} {i}', 'Subject': f'{prefix} subject {i % 2}'})
+        return rows
+
+    def import_chunk(self, rows, incremental=False):
+        util = ContentSheetUtil(workers=2, incremental=incremental)
+        manifest = ImportManifest(self.source_folder) if incremental else None
+        chunk = list(util.stage_sheet_files(self.source_folder, rows, manifest))
+        with CaptureQueriesContext(connection) as queries:
+            results = util.import_chunk(chunk, MetadataResolver(), manifest)
+        return [error for row, error in results], len(queries)
+
+    def test_queries_do_not_grow_with_the_chunk(self):
+        # each chunk creates its own two subjects
+        errors, small_chunk_queries = self.import_chunk(self.rows('small', 3))
+        self.assertEqual(errors, [None] * 3)
+        errors, large_chunk_queries = self.import_chunk(self.rows('large', 30))
+        self.assertEqual(errors, [None] * 30)
+        self.assertEqual(small_chunk_queries, large_chunk_queries)
+
+    def test_files_of_existing_contents_are_rejected(self):
+        rows = self.rows('book', 3)
+        with open(os.path.join(self.source_folder, 'book1.pdf'), 'rb') as source:
+            Content.objects.create(title='Existing', file_name='existing.pdf', content_hash=sha256(source))
+        errors, queries = self.import_chunk(rows)
+        self.assertEqual(errors, [None, str(['File already exists with name existing.pdf']), None])
+        self.assertFalse(os.path.exists(os.path.join(self.contents_root, 'book1.pdf')))
+
+    def test_incremental_import_records_files_imported_before_the_manifest(self):
+        rows = self.rows('book', 3)
+        shutil.copy(os.path.join(self.source_folder, 'book1.pdf'), self.contents_root)
+        with open(os.path.join(self.source_folder, 'book1.pdf'), 'rb') as source:
+            existing = Content.objects.create(title='Existing', file_name='book1.pdf', content_hash=sha256(source))
+        errors, queries = self.import_chunk(rows, incremental=True)
+        self.assertEqual(errors, [None, UNCHANGED, None])
+        self.assertEqual(ImportManifest(self.source_folder).entries[os.path.join(self.source_folder, 'book1.pdf')][2],
+                         existing.content_hash)
+
+
+def folder_tree(version):
+    """
+    Folders of a version keyed by their names from the top level folder down, such as ('Root', 'A', 'A1')
+    """
+    folders = {folder.id: folder for folder in LibraryFolder.objects.filter(version=version)}
+
+    def name_path(folder):
+        parent = folders.get(folder.parent_id)
+        return (name_path(parent) if parent else ()) + (folder.folder_name,)
+
+    return {name_path(folder): folder for folder in folders.values()}
+
+
+class LibraryVersionCloneTests(TestCase):
+
+    def setUp(self):
+        self.client = admin_client()
+        self.version, self.folders = make_library('1')
+        make_library('2')
+
+    def clone(self, version):
+        response = self.client.get(f'/api/library_versions/{version.id}/clone/')
+        self.assertEqual(response.status_code, 200)
+        return LibraryVersion.objects.get(id=response.json()['data']['id'])
+
+    def assert_clone_of(self, clone, version):
+        source = folder_tree(version)
+        cloned = folder_tree(clone)
+        self.assertEqual(cloned.keys(), source.keys())
+        self.assertFalse({folder.id for folder in cloned.values()} & {folder.id for folder in source.values()})
+        for name_path, folder in cloned.items():
+            parent = cloned.get(name_path[:-1])
+            self.assertEqual(folder.path, (parent.path if parent else '/') + f'{folder.id}/')
+            self.assertEqual(folder.origin_id, source[name_path].origin_id)
+            self.assertEqual(set(folder.library_content.values_list('id', flat=True)),
+                             set(source[name_path].library_content.values_list('id', flat=True)))
+
+    def test_clone_copies_the_folder_tree_and_contents(self):
+        clone = self.clone(self.version)
+        self.assertEqual(clone.version_number, '10')
+        self.assertEqual(list(clone.library_modules.all()), list(self.version.library_modules.all()))
+        self.assert_clone_of(clone, self.version)
+        self.assertEqual({folder.origin_id for folder in folder_tree(clone).values()},
+                         {folder.id for folder in self.folders.values()})
+        # the contents placed in two folders are copied into both
+        self.assertEqual(LibraryFolder.library_content.through.objects.filter(libraryfolder__version=clone).count(),
+                         14)
+
+    def test_clone_of_a_clone_keeps_the_origins(self):
+        clone = self.clone(self.version)
+        LibraryFolder.objects.create(version=clone, folder_name='New', parent=folder_tree(clone)[('Root', 'A', 'A1')])
+        second_clone = self.clone(clone)
+        self.assertEqual(second_clone.version_number, '100')
+        self.assert_clone_of(second_clone, clone)
+        self.assertEqual(folder_tree(second_clone)[('Root', 'A', 'A1')].origin_id, self.folders['A1'].id)
+
+
+class LibraryVersionCapacityTests(ContentsRootMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.client = admin_client()
+        self.version, folders = make_library('1')
+        make_library('2')
+        # a second top level folder sharing a content with Root, and a content with no size yet
+        extra = LibraryFolder.objects.create(version=self.version, folder_name='Extra')
+        unsized = Content.objects.create(title='Unsized', file_name='unsized.pdf')
+        extra.library_content.add(unsized, folders['Root'].library_content.first())
+        module = self.version.library_modules.get()
+        os.mkdir(os.path.join(self.media_root, 'modules'))
+        with open(os.path.join(self.media_root, 'modules', 'module.zip'), 'wb') as module_file:
+            module_file.write(b'm' * 34)
+        module.module_file = 'modules/module.zip'
+        module.save()
+
+    def capacity(self, version):
+        response = self.client.get(f'/api/library_versions/{version.id}/capacity/')
+        self.assertEqual(response.status_code, 200)
+        return response.json()['data']
+
+    def test_capacity(self):
+        with mock.patch.object(utils, 'CARD_SIZES', (1299, 1300)):
+            capacity = self.capacity(self.version)
+        self.assertEqual(capacity['content_count'], 13)
+        self.assertEqual(capacity['content_bytes'], sum(100 + i for i in range(12)))
+        self.assertEqual(capacity['unsized_content_count'], 1)
+        self.assertEqual(capacity['module_bytes'], 34)
+        self.assertEqual(capacity['total_bytes'], 1300)
+        self.assertEqual([(folder['folder_name'], folder['file_count'], folder['bytes'])
+                          for folder in capacity['folders']], [('Root', 12, 1266), ('Extra', 2, 100)])
+        self.assertEqual(capacity['cards'], [{'size': 1299, 'fits': False}, {'size': 1300, 'fits': True}])
+
+    def test_module_without_a_file_takes_no_space(self):
+        os.remove(os.path.join(self.media_root, 'modules', 'module.zip'))
+        self.assertEqual(self.capacity(self.version)['module_bytes'], 0)
+
+    def test_empty_version(self):
+        version = LibraryVersion.objects.create(library_name='Library', version_number='3')
+        capacity = self.capacity(version)
+        self.assertEqual((capacity['content_count'], capacity['content_bytes'], capacity['unsized_content_count'],
+                          capacity['module_bytes'], capacity['folders']), (0, 0, 0, 0, []))
+        self.assertTrue(all(card['fits'] for card in capacity['cards']))
+
+
+class LibraryVersionTreeTests(TestCase):
+
+    def setUp(self):
+        self.client = admin_client()
+        self.version, folders = make_library('1')
+        make_library('2')
+        LibraryFolder.objects.create(version=self.version, folder_name='Empty', parent=folders['A1'])
+
+    def tree(self, version):
+        response = self.client.get(f'/api/library_versions/{version.id}/tree/')
+        self.assertEqual(response.status_code, 200)
+        return response.json()['data']
+
+    def summarize(self, folders):
+        return {folder['folder_name']: (folder['content_count'], folder['content_bytes'], folder['total_content_count'],
+                                        folder['total_bytes'], self.summarize(folder['subfolders']))
+                for folder in folders}
+
+    def test_tree_rolls_up_distinct_contents(self):
+        # contents 0 and 3 are each placed in two folders, and only counted once in the folders above them
+        self.assertEqual(self.summarize(self.tree(self.version)), {
+            'Root': (3, 303, 12, 1266, {
+                'A': (3, 312, 6, 642, {
+                    'A1': (4, 433, 4, 433, {
+                        'Empty': (0, 0, 0, 0, {}),
+                    }),
+                }),
+                'B': (4, 421, 4, 421, {}),
+            }),
+        })
+
+    def test_empty_version(self):
+        version = LibraryVersion.objects.create(library_name='Library', version_number='3')
+        self.assertEqual(self.tree(version), [])
+
+
+class FolderContentTests(TestCase):
+
+    def setUp(self):
+        self.client = admin_client()
+        self.version, self.folders = make_library('1')
+        self.contents = list(Content.objects.order_by('id').values_list('id', flat=True))
+
+    def contents_of(self, name):
+        return set(self.folders[name].library_content.values_list('id', flat=True))
+
+    def batch(self, changes):
+        return self.client.post('/api/library_folders/batch_content/', {'changes': changes}, format='json')
+
+    def test_batch_adds_and_removes(self):
+        root, a, b = self.folders['Root'], self.folders['A'], self.folders['B']
+        response = self.batch([
+            # the first content is already in B, so only the second one is added there
+            {'folder_id': b.id, 'add': self.contents[:2] + self.contents[1:2]},
+            {'folder_id': a.id, 'add': self.contents[9:10], 'remove': self.contents[3:5]},
+            {'folder_id': root.id, 'remove': self.contents[:1] + self.contents[11:12]},
+        ])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['data'], {'added_count': 2, 'removed_count': 3})
+        self.assertEqual(self.contents_of('B'), set(self.contents[:2] + self.contents[6:9]))
+        self.assertEqual(self.contents_of('A'), {self.contents[5], self.contents[9]})
+        self.assertEqual(self.contents_of('Root'), set(self.contents[1:3]))
+
+    def test_batch_with_an_unknown_id_changes_nothing(self):
+        before = {name: self.contents_of(name) for name in self.folders}
+        missing_content = max(self.contents) + 1
+        response = self.batch([
+            {'folder_id': self.folders['A'].id, 'remove': self.contents[3:5]},
+            {'folder_id': self.folders['B'].id, 'add': [missing_content]},
+        ])
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()['error'], [f'Contents not found: {missing_content}'])
+        response = self.batch([{'folder_id': 'A', 'add': self.contents[:1]}])
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual({name: self.contents_of(name) for name in self.folders}, before)
+
+    def test_add_and_remove_content(self):
+        a = self.folders['A']
+        url = f'/api/library_folders/{a.id}/'
+        self.assertEqual(self.client.post(url + 'addcontent/', {'content_ids': self.contents[:1]},
+                                          format='json').status_code, 200)
+        self.assertEqual(self.client.post(url + 'removecontent/', {'content_ids': self.contents[3:4]},
+                                          format='json').status_code, 200)
+        self.assertEqual(self.contents_of('A'), {self.contents[0], self.contents[4], self.contents[5]})
+        self.assertEqual(self.client.post('/api/library_folders/0/addcontent/', {'content_ids': []},
+                                          format='json').status_code, 404)
+
+    def test_content_ids_must_be_lists_of_numbers(self):
+        before = {name: self.contents_of(name) for name in self.folders}
+        a = self.folders['A']
+        for ids in (str(self.contents[0]), [str(self.contents[0])], self.contents[0], [1.5], [True], {'id': 1}, None):
+            with self.subTest(ids=ids):
+                response = self.batch([{'folder_id': a.id, 'add': ids}])
+                self.assertEqual(response.status_code, 400)
+                self.assertEqual(response.json()['error'], ['Content ids must be lists of numbers'])
+                response = self.batch([{'folder_id': a.id, 'remove': ids}])
+                self.assertEqual(response.status_code, 400)
+        response = self.client.post(f'/api/library_folders/{a.id}/addcontent/',
+                                    {'content_ids': str(self.contents[0])}, format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual({name: self.contents_of(name) for name in self.folders}, before)
+
+
+class LibraryVersionDiffTests(TestCase):
+
+    def setUp(self):
+        self.client = admin_client()
+        self.version, self.folders = make_library('1')
+        response = self.client.get(f'/api/library_versions/{self.version.id}/clone/')
+        self.clone = LibraryVersion.objects.get(id=response.json()['data']['id'])
+        self.cloned = {name_path[-1]: folder for name_path, folder in folder_tree(self.clone).items()}
+        self.contents = list(Content.objects.order_by('id'))
+
+    def diff(self):
+        response = self.client.get(f'/api/library_versions/{self.clone.id}/diff/?base={self.version.id}')
+        self.assertEqual(response.status_code, 200)
+        return response.json()['data']
+
+    def test_clone_without_changes(self):
+        self.assertEqual(self.diff(), {
+            'base_version': self.version.id,
+            'version': self.clone.id,
+            'folders': {'added': [], 'removed': [], 'moved': [], 'renamed': []},
+            'contents': [],
+            'added_content_count': 0,
+            'added_bytes': 0,
+            'removed_content_count': 0,
+            'removed_bytes': 0,
+            'base_bytes': 1266,
+            'bytes': 1266,
+            'size_delta': 0,
+        })
+
+    def test_changed_clone(self):
+        root, a, a1 = self.cloned['Root'], self.cloned['A'], self.cloned['A1']
+        # B holds contents 6 to 8 and content 0, which stays in Root
+        self.cloned['B'].delete()
+        a1.parent = root
+        a1.folder_name = 'A1 renamed'
+        a1.save()
+        c = LibraryFolder.objects.create(version=self.clone, folder_name='C', parent=a)
+        c.library_content.add(self.contents[6])
+        new_content = Content.objects.create(title='New', file_name='new.pdf', filesize=1000)
+        a.library_content.add(new_content)
+        root.library_content.remove(self.contents[1])
+
+        self.assertEqual(self.diff(), {
+            'base_version': self.version.id,
+            'version': self.clone.id,
+            'folders': {
+                'added': [{'id': c.id, 'folder_name': 'C', 'parent': a.id}],
+                'removed': [{'id': self.folders['B'].id, 'folder_name': 'B', 'parent': self.folders['Root'].id}],
+                'moved': [{'id': a1.id, 'base_id': self.folders['A1'].id, 'folder_name': 'A1 renamed',
+                           'parent': root.id, 'base_parent': self.folders['A'].id}],
+                'renamed': [{'id': a1.id, 'base_id': self.folders['A1'].id, 'folder_name': 'A1 renamed',
+                             'base_folder_name': 'A1'}],
+            },
+            'contents': [
+                {'id': root.id, 'base_id': self.folders['Root'].id, 'added': [], 'removed': [self.contents[1].id]},
+                {'id': a.id, 'base_id': self.folders['A'].id, 'added': [new_content.id], 'removed': []},
+                {'id': c.id, 'base_id': None, 'added': [self.contents[6].id], 'removed': []},
+                {'id': None, 'base_id': self.folders['B'].id, 'added': [],
+                 'removed': [content.id for content in self.contents[:1] + self.contents[6:9]]},
+            ],
+            'added_content_count': 1,
+            'added_bytes': 1000,
+            'removed_content_count': 3,
+            'removed_bytes': 101 + 107 + 108,
+            'base_bytes': 1266,
+            'bytes': 1266 - 101 - 107 - 108 + 1000,
+            'size_delta': 1000 - 101 - 107 - 108,
+        })
+
+    def test_diff_needs_a_base_version(self):
+        self.assertEqual(self.client.get(f'/api/library_versions/{self.clone.id}/diff/').status_code, 400)
+        self.assertEqual(self.client.get(f'/api/library_versions/{self.clone.id}/diff/?base=0').status_code, 404)
+
+
+class LinkFileTests(SimpleTestCase):
+
+    def setUp(self):
+        folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, folder)
+        self.source = os.path.join(folder, 'source.pdf')
+        self.destination = os.path.join(folder, 'destination.pdf')
+        with open(self.source, 'wb') as source:
+            source.write(b'library file')
+
+    def assert_copied(self, same_file):
+        with open(self.destination, 'rb') as destination:
+            self.assertEqual(destination.read(), b'library file')
+        self.assertEqual(os.path.samefile(self.source, self.destination), same_file)
+
+    def test_hardlink(self):
+        self.assertEqual(link_file(self.source, self.destination), 'link')
+        self.assert_copied(True)
+
+    def test_reflink_across_filesystems(self):
+        ioctl = mock.Mock()
+        with mock.patch('os.link', side_effect=OSError(errno.EXDEV, 'cross-device link')), \
+                mock.patch.object(utils, 'fcntl', mock.Mock(ioctl=ioctl)):
+            self.assertEqual(link_file(self.source, self.destination), 'reflink')
+        self.assertEqual(ioctl.call_args[0][1], utils.FICLONE)
+
+    def test_copy_when_reflinks_are_not_supported(self):
+        with mock.patch('os.link', side_effect=OSError(errno.EXDEV, 'cross-device link')), \
+                mock.patch.object(utils.fcntl, 'ioctl', side_effect=OSError(errno.EOPNOTSUPP, 'not supported')):
+            self.assertEqual(link_file(self.source, self.destination), 'copy')
+        self.assert_copied(False)
+
+    def test_copy_without_fcntl(self):
+        with mock.patch('os.link', side_effect=OSError(errno.EPERM, 'not permitted')), \
+                mock.patch.object(utils, 'fcntl', None):
+            self.assertEqual(link_file(self.source, self.destination), 'copy')
+        self.assert_copied(False)
+
+    def test_other_errors_are_raised(self):
+        with self.assertRaises(FileNotFoundError):
+            link_file(self.source + '.missing', self.destination)
+        self.assertFalse(os.path.exists(self.destination))
+
+
+class SheetReaderTests(SimpleTestCase):
+    rows = [
+        {'File Name': 'a.pdf', 'Title': 'Solar Power', 'Year Published': '2019', 'Subject': 'Energy | Science'},
+        {'File Name': 'b.pdf', 'Title': 'Clean Water', 'Year Published': '', 'Subject': '7'},
+    ]
+
+    def read(self, data, sheet_format):
+        return list(read_sheet_rows(io.BytesIO(data), sheet_format))
+
+    def test_xlsx(self):
+        from openpyxl import Workbook
+        workbook = Workbook()
+        sheet = workbook.active
+        sheet.append(['File Name', 'Title', 'Year Published', 'Subject', None])
+        sheet.append(['a.pdf', 'Solar Power', 2019, 'Energy | Science'])
+        sheet.append([None, None, None, None])
+        sheet.append(['b.pdf', 'Clean Water', None, 7])
+        sheet.append(['c.pdf', 'Dated', datetime.datetime(2020, 5, 1), 2.5])
+        sheet_file = io.BytesIO()
+        workbook.save(sheet_file)
+        self.assertEqual(self.read(sheet_file.getvalue(), 'xlsx'), self.rows + [
+            {'File Name': 'c.pdf', 'Title': 'Dated', 'Year Published': '2020-05-01 00:00:00', 'Subject': '2.5'},
+        ])
+
+    def test_csv_with_byte_order_mark(self):
+        data = '\ufeffFile Name,Title,Year Published,Subject\r\n' \
+               'a.pdf,Solar Power,2019,Energy | Science\r\n' \
+               'b.pdf,"Clean Water",,7\r\n'
+        self.assertEqual(self.read(data.encode('utf-8'), 'csv'), self.rows)
+
+    def test_ndjson(self):
+        data = '\n'.join(json.dumps(row) for row in self.rows) + '\n\n'
+        self.assertEqual(self.read(data.encode('utf-8'), 'ndjson'), self.rows)
+
+    def test_json(self):
+        self.assertEqual(self.read(json.dumps(self.rows).encode('utf-8'), 'json'), self.rows)
+        self.assertEqual(self.read(b' [ ] ', 'json'), [])
+
+    def test_json_rows_split_across_reads(self):
+        data = json.dumps(self.rows, indent=2).encode('utf-8')
+        for read_size in (1, 5, 7, 64):
+            with mock.patch('content_management.sheet_readers.READ_SIZE', read_size):
+                self.assertEqual(self.read(data, 'json'), self.rows)
+
+    def test_json_malformed(self):
+        for data in (b'{"a": 1}', b'[{"a": 1} {"b": 2}]', b'[{"a": 1},]', b'[{"a": 1}, {"b"', b'[{"a": 1},', b''):
+            with self.subTest(data=data), mock.patch('content_management.sheet_readers.READ_SIZE', 4):
+                with self.assertRaises(ValueError):
+                    self.read(data, 'json')
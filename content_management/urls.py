@@ -6,7 +6,7 @@ from dlms import settings
 from .views import (
     ContentViewSet, MetadataViewSet, MetadataTypeViewSet, UserViewSet,
     LibraryFolderViewSet, LibraryVersionViewSet, LibLayoutImageViewSet, LibraryBuildView, metadata_sheet, BulkAddView, get_csrf,
-    LibraryModuleViewSet, disk_info)
+    LibraryModuleViewSet, ImportJobViewSet, UploadSessionViewSet, LibraryBuildViewSet, disk_info)
 
 router = routers.DefaultRouter()
 router.register(r'contents', ContentViewSet)
@@ -17,6 +17,9 @@ router.register(r'library_versions', LibraryVersionViewSet)
 router.register(r'library_folders', LibraryFolderViewSet)
 router.register(r'users', UserViewSet)
 router.register(r'library_modules', LibraryModuleViewSet)
+router.register(r'import_jobs', ImportJobViewSet)
+router.register(r'upload_sessions', UploadSessionViewSet)
+router.register(r'library_builds', LibraryBuildViewSet)
 
 
 urlpatterns = [
@@ -1,21 +1,32 @@
 import datetime
+import errno
+import itertools
 import json
 import os
-from typing import Dict, Union
+import shutil
+import tarfile
+import tempfile
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, NamedTuple
 
 from django.core.exceptions import ValidationError
 from django.core.files import File
+from django.core.files.storage import default_storage
 from django.utils import timezone
 from django.utils.text import get_valid_filename
 from rest_framework import status
+from django.db import connection, transaction
+from django.db.models import Count
 from django.db.models.functions import Substr
 
 from dlms import settings
-from content_management.library_db_utils import LibraryDbUtil
+from content_management.library_db_utils import LibraryDbUtil, write_sql_patch
 from content_management.models import (
     Content,
-    Metadata, MetadataType, LibraryFolder, LibraryModule, LibraryVersion)
-from content_management.validators import validate_unique_filename, validate_unique_file
+    Metadata, MetadataType, LibraryFolder, LibraryModule, LibraryVersion, ImportManifestEntry, UploadSession)
+from content_management.validators import validate_unique_filename, validate_unique_hash
 
 
 import hashlib
@@ -23,69 +34,54 @@ import hashlib
 
 class ContentSheetUtil:
 
-    def upload_sheet_contents(self, sheet_contents):
+    def __init__(self, workers=None, chunk_size=None, incremental=False):
         """
-        This method adds bulk content data from the Excel sheet uploaded
-        :param sheet_contents:
+        :param workers: number of threads that copy and hash files while the
+            main thread writes to the database, defaults to settings.IMPORT_WORKERS
+        :param chunk_size: number of rows inserted per transaction,
+            defaults to settings.IMPORT_CHUNK_SIZE
+        :param incremental: skip files that an earlier import already added,
+            using the ImportManifestEntry records of the content path
+        """
+        self.workers = max(1, settings.IMPORT_WORKERS if workers is None else workers)
+        self.chunk_size = max(1, settings.IMPORT_CHUNK_SIZE if chunk_size is None else chunk_size)
+        self.incremental = incremental
+
+    def upload_sheet_rows(self, sheet_rows, main_path, progress=None):
+        """
+        Adds bulk content from an iterable of sheet rows
+        Rows are pulled from sheet_rows one chunk at a time, so a generator
+        reading the sheet incrementally keeps memory use bounded by the chunk size
+        :param sheet_rows: iterable of dicts keyed by sheet column names
+        :param main_path: folder the rows' file names are relative to
+        :param progress: optional callable that is passed the number of rows done,
+            the list of unsuccessful uploads and the number of skipped rows after each chunk
         :return: success status
         """
         unsuccessful_uploads = []
         successful_uploads_count = 0
+        skipped_count = 0
         try:
-            content_data = json.loads(sheet_contents.get("sheet_data"))
-            main_path = sheet_contents.get("content_path")
-            for each_content in content_data:
-                # if the actual file is not uploaded, don't upload its metadata
-                file_path = os.path.join(main_path, each_content.get("File Name"))
-                if os.path.exists(file_path) is not True:
-                    unsuccessful_uploads.append({'file_name': each_content.get("File Name"),
-                                                 'error': 'file does not exist'})
-                    continue
-                else:
-                    try:
-                        content = Content()
-                        content.title = each_content.get("Title")
-                        content.description = each_content.get("Description")
-                        content.copyright_notes = each_content.get("Copyright Notes")
-                        content.reviewed_on = datetime.datetime.now()
-                        content.rights_statement = each_content.get("Rights Statement")
-                        if each_content.get("Year Published"):
-                            try:
-                                content.published_date = datetime.date(each_content.get("Year Published"), 1, 1)
-                            except ValueError:
-                                content.published_date = None
-                        content.modified_on = timezone.now()
-                        content.additional_notes = each_content.get("Additional Notes")
-                        content.active = True
-                        content.filesize = os.stat(file_path).st_size
-                        try:
-                            content.save()
-                        except Exception as e:
-                            raise Exception(str(e))
-                        try:
-                            upload_content_file(file_path, content)
-                        except (Exception, ValidationError) as e:
-                            content.delete()
-                            raise e
-                        try:
-                            metadata = get_associated_meta(each_content)
-                            for metadata_item in metadata:
-                                obj, created = Metadata.objects.get_or_create(defaults={'name': metadata_item.name},
-                                                                              name__iexact=metadata_item.name,
-                                                                              type_id=metadata_item.type.id)
-                                content.metadata.add(obj)
-                            content.save()
-                            successful_uploads_count = successful_uploads_count + 1
-                        except Exception as e:
-                            content.delete()
-                            raise e
-                    except (Exception, ValidationError) as e:
-                        unsuccessful_uploads.append({'file_name': each_content.get("File Name"), 'error': str(e)})
-                        continue
+            metadata_resolver = MetadataResolver()
+            manifest = ImportManifest(main_path) if self.incremental else None
+            staged_rows = self.stage_sheet_files(main_path, sheet_rows, manifest)
+            for chunk in iter(lambda: list(itertools.islice(staged_rows, self.chunk_size)), []):
+                for each_content, error in self.import_chunk(chunk, metadata_resolver, manifest):
+                    if error is None:
+                        successful_uploads_count = successful_uploads_count + 1
+                    elif error is UNCHANGED:
+                        skipped_count = skipped_count + 1
+                    else:
+                        unsuccessful_uploads.append({'file_name': each_content.get("File Name"), 'error': error})
+                if progress is not None:
+                    rows_done = successful_uploads_count + len(unsuccessful_uploads) + skipped_count
+                    progress(rows_done, unsuccessful_uploads, skipped_count)
             data = {
                 'success_count': successful_uploads_count,
                 'unsuccessful_uploads': unsuccessful_uploads,
             }
+            if self.incremental:
+                data['skipped_count'] = skipped_count
             return data
 
         except Exception as e:
@@ -96,10 +92,170 @@ class ContentSheetUtil:
             }
             return data
 
+    def import_chunk(self, chunk, metadata_resolver, manifest=None):
+        """
+        Commits the staged files of a chunk of sheet rows, then inserts their
+        contents and metadata links with bulk inserts in a single transaction.
+        If the bulk insert fails, the rows are retried one savepoint at a time
+        so that only the failing rows are rejected.
+        :param chunk: list of (row, StagedFile or None, error or None) from stage_sheet_files
+        :param metadata_resolver: MetadataResolver shared by the whole import
+        :param manifest: ImportManifest of an incremental import
+        :return: list of (row, error or None) in the order of chunk,
+            error is UNCHANGED for rows skipped by an incremental import
+        """
+        errors = []
+        committed = []
+        chunk_hashes = {}
+        already_imported = []
+        # contents that already have the files of the chunk, looked up in one query for the whole chunk
+        existing = {}
+        for content_hash, content_id, file_name in Content.objects.filter(
+                content_hash__in=[staged.content_hash for _, staged, error in chunk if error is None]
+        ).values_list('content_hash', 'id', 'file_name'):
+            existing.setdefault(content_hash, (content_id, file_name))
+        existing_hashes = {content_hash: file_name for content_hash, (_, file_name) in existing.items()}
+        for each_content, staged, error in chunk:
+            errors.append(error)
+            if error is UNCHANGED and staged is not None:
+                already_imported.append((staged, None))
+            # if the actual file is not uploaded, don't upload its metadata
+            if error is not None:
+                continue
+            try:
+                if manifest is not None:
+                    # files imported before the manifest existed are only recorded
+                    if staged.content_hash in existing:
+                        discard_staged_file(staged)
+                        already_imported.append((staged, existing[staged.content_hash][0]))
+                        errors[-1] = UNCHANGED
+                        continue
+                    if staged.temp_path is None:
+                        raise ValidationError('Filename already exists.')
+                content = build_sheet_content(each_content)
+                commit_staged_file(staged, content, chunk_hashes, existing_hashes)
+                committed.append((len(errors) - 1, each_content, content))
+            except (Exception, ValidationError) as e:
+                discard_staged_file(staged)
+                errors[-1] = str(e)
+
+        try:
+            with transaction.atomic():
+                try:
+                    with transaction.atomic():
+                        Content.objects.bulk_create([content for index, each_content, content in committed])
+                        metadata_resolver.add_metadata([
+                            (each_content, content) for index, each_content, content in committed
+                        ])
+                except Exception:
+                    for index, each_content, content in committed:
+                        # the bulk insert may have assigned ids before it was rolled back
+                        content.pk = None
+                        content._state.adding = True
+                        try:
+                            with transaction.atomic():
+                                content.save()
+                                metadata_resolver.add_metadata([(each_content, content)])
+                        except Exception as e:
+                            errors[index] = str(e)
+                if manifest is not None:
+                    manifest.record(already_imported + [
+                        (chunk[index][1], content.pk) for index, each_content, content in committed
+                        if errors[index] is None
+                    ])
+        except Exception as e:
+            metadata_resolver.reload()
+            for index, each_content, content in committed:
+                if errors[index] is None:
+                    errors[index] = str(e)
+
+        # files of rejected rows are removed directly, their contents were never saved
+        for index, each_content, content in committed:
+            if errors[index] is not None and os.path.isfile(content.content_file.path):
+                os.remove(content.content_file.path)
 
-def get_associated_meta(sheet_row):
+        return [(each_content, error) for (each_content, staged, _), error in zip(chunk, errors)]
+
+    def stage_sheet_files(self, main_path, rows, manifest=None):
+        """
+        Copies and hashes the files of the sheet rows on a thread pool
+        Files are staged at most a few rows ahead of the caller so that a large
+        sheet does not stage every file before the first one is committed.
+        :param main_path: folder the sheet's file names are relative to
+        :param rows: iterable of sheet rows
+        :param manifest: ImportManifest of an incremental import
+        :return: generator of (row, StagedFile or None, error or None) in sheet order
+        """
+        pending = deque()
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            try:
+                for row in rows:
+                    pending.append((row, executor.submit(stage_sheet_file, main_path, row, manifest)))
+                    if len(pending) > self.workers * 2:
+                        row, future = pending.popleft()
+                        yield (row,) + future.result()
+                while pending:
+                    row, future = pending.popleft()
+                    yield (row,) + future.result()
+            finally:
+                # the caller stopped early, don't leave temporary files behind
+                for row, future in pending:
+                    staged, error = future.result()
+                    if staged is not None:
+                        discard_staged_file(staged)
+
+
+# error of sheet rows that an incremental import found already imported
+UNCHANGED = object()
+
+
+def stage_sheet_file(main_path, sheet_row, manifest=None):
+    """
+    Stages the file named by a sheet row, runs on a ContentSheetUtil worker thread
+    :return: (StagedFile, None) on success, (None, error message) or
+        (StagedFile or None, UNCHANGED) if the manifest shows the file is already imported
+    """
+    try:
+        file_path = os.path.join(main_path, sheet_row.get("File Name"))
+        if os.path.exists(file_path) is not True:
+            return None, 'file does not exist'
+        if manifest is not None:
+            unchanged = manifest.check_unchanged(file_path)
+            if unchanged is not False:
+                return unchanged, UNCHANGED
+            base_name = get_valid_filename(os.path.basename(file_path))
+            if os.path.isfile(os.path.join(settings.CONTENTS_ROOT, base_name)):
+                # may have been imported before manifests were kept, let import_chunk check its hash
+                return hash_source_file(file_path), None
+        return stage_content_file(file_path), None
+    except (Exception, ValidationError) as e:
+        return None, str(e)
+
+
+def build_sheet_content(sheet_row):
+    content = Content()
+    content.title = sheet_row.get("Title")
+    content.description = sheet_row.get("Description")
+    content.copyright_notes = sheet_row.get("Copyright Notes")
+    content.reviewed_on = datetime.datetime.now()
+    content.rights_statement = sheet_row.get("Rights Statement")
+    if sheet_row.get("Year Published"):
+        try:
+            # CSV and NDJSON sheets may carry the year as a string
+            content.published_date = datetime.date(int(sheet_row.get("Year Published")), 1, 1)
+        except (ValueError, TypeError):
+            content.published_date = None
+    content.modified_on = timezone.now()
+    content.additional_notes = sheet_row.get("Additional Notes")
+    content.active = True
+    return content
+
+
+def get_associated_meta(sheet_row, metadata_types=None):
     meta_list = []
-    for metadata_type in MetadataType.objects.all():
+    if metadata_types is None:
+        metadata_types = MetadataType.objects.all()
+    for metadata_type in metadata_types:
         if sheet_row.get(metadata_type.name) == '' or sheet_row.get(metadata_type.name) is None:
             continue
         meta_values = sheet_row[metadata_type.name].split(' | ')
@@ -109,46 +265,961 @@ def get_associated_meta(sheet_row):
     return meta_list
 
 
-def upload_content_file(full_path, content: Content):
-    content_file = open(full_path, "rb")
-    base_name = get_valid_filename(os.path.basename(content_file.name))
-    validate_unique_filename(File(content_file, base_name))
-    validate_unique_file(File(content_file, base_name))
-    content.file_name = base_name
-    content.content_file.save(base_name, File(content_file))
-    content_file.close()
+class MetadataResolver:
+    """
+    Maps sheet metadata values to Metadata ids for a whole import.
+    Metadata types and existing metadata are loaded once, names are matched
+    case-insensitively like the name__iexact lookups elsewhere, and missing
+    metadata is created with a single bulk_create per call.
+    """
+
+    def __init__(self):
+        self.reload()
+
+    def reload(self):
+        """
+        Reloads the cache, needed after a transaction that created metadata was rolled back
+        """
+        self.metadata_types = list(MetadataType.objects.all())
+        self.metadata_ids = {}
+        # reversed so the oldest of any case-insensitive duplicates wins
+        for metadata_id, type_id, name in Metadata.objects.order_by('-id').values_list('id', 'type_id', 'name'):
+            self.metadata_ids[(type_id, name.upper())] = metadata_id
+
+    def resolve(self, sheet_rows, created_keys=None):
+        """
+        :param sheet_rows: list of sheet rows
+        :param created_keys: optional list the cache keys of created metadata are appended to
+        :return: list with the metadata ids of each row
+        """
+        row_metadata = [get_associated_meta(sheet_row, self.metadata_types) for sheet_row in sheet_rows]
+        missing = {}
+        for metadata_list in row_metadata:
+            for metadata in metadata_list:
+                key = (metadata.type_id, metadata.name.upper())
+                if key not in self.metadata_ids and key not in missing:
+                    missing[key] = metadata
+        if missing:
+            created = Metadata.objects.bulk_create(missing.values())
+            for key, metadata in zip(missing.keys(), created):
+                self.metadata_ids[key] = metadata.id
+            if created_keys is not None:
+                created_keys.extend(missing.keys())
+        return [
+            [self.metadata_ids[(metadata.type_id, metadata.name.upper())] for metadata in metadata_list]
+            for metadata_list in row_metadata
+        ]
+
+    def add_metadata(self, sheet_contents):
+        """
+        Links saved contents to the metadata of their sheet rows with one bulk insert
+        :param sheet_contents: list of (sheet row, saved Content)
+        """
+        created_keys = []
+        try:
+            metadata_ids = self.resolve([sheet_row for sheet_row, content in sheet_contents], created_keys)
+            ContentMetadata = Content.metadata.through
+            ContentMetadata.objects.bulk_create([
+                ContentMetadata(content_id=content.id, metadata_id=metadata_id)
+                for (sheet_row, content), row_metadata_ids in zip(sheet_contents, metadata_ids)
+                for metadata_id in dict.fromkeys(row_metadata_ids)
+            ], ignore_conflicts=True)
+        except Exception:
+            # the caller's savepoint rolls back the metadata created here
+            for key in created_keys:
+                del self.metadata_ids[key]
+            raise
+
+
+class ImportManifest:
+    """
+    Size, modification time and hash of the files that earlier imports added
+    from a content path, so that incremental imports can skip unchanged files
+    without reading them. Entries are loaded once per import.
+    """
+
+    def __init__(self, main_path):
+        self.entries = {
+            source_path: (size, mtime_ns, content_hash)
+            for source_path, size, mtime_ns, content_hash in ImportManifestEntry.objects.filter(
+                source_path__startswith=os.path.join(os.path.abspath(main_path), '')
+            ).values_list('source_path', 'size', 'mtime_ns', 'content_hash')
+        }
+
+    def check_unchanged(self, file_path):
+        """
+        Checks a file against the manifest, runs on a ContentSheetUtil worker thread
+        Files with the recorded size and mtime are unchanged without being read,
+        only files that were touched since are hashed again.
+        :return: False if the file must be imported, None if it is unchanged, or a
+            StagedFile without a temporary file if only its manifest entry is stale
+        """
+        source_path = os.path.abspath(file_path)
+        entry = self.entries.get(source_path)
+        if entry is None:
+            return False
+        size, mtime_ns, content_hash = entry
+        stat = os.stat(source_path)
+        if stat.st_size != size:
+            return False
+        if stat.st_mtime_ns == mtime_ns:
+            return None
+        hashed = hash_source_file(source_path)
+        return hashed if hashed.content_hash == content_hash else False
+
+    def record(self, imported):
+        """
+        Writes the manifest entries of imported files
+        :param imported: list of (StagedFile, id of its Content or None to keep the recorded one)
+        """
+        if not imported:
+            return
+        # a sheet can list the same file twice
+        imported = {staged.source_path: (staged, content_id) for staged, content_id in imported}
+        recorded_ids = dict(ImportManifestEntry.objects.filter(source_path__in=imported.keys())
+                            .values_list('source_path', 'content_id'))
+        entries = []
+        for source_path, (staged, content_id) in imported.items():
+            content_id = recorded_ids.get(source_path) if content_id is None else content_id
+            if content_id is None:
+                continue
+            entries.append(ImportManifestEntry(
+                source_path=source_path,
+                size=staged.size,
+                mtime_ns=staged.mtime_ns,
+                content_hash=staged.content_hash,
+                content_id=content_id
+            ))
+            self.entries[source_path] = (staged.size, staged.mtime_ns, staged.content_hash)
+        ImportManifestEntry.objects.filter(source_path__in=imported.keys()).delete()
+        ImportManifestEntry.objects.bulk_create(entries)
+
+
+# files are copied into storage in chunks of this size while being hashed
+COPY_CHUNK_SIZE = 1024 * 1024
+
+
+class StagedFile(NamedTuple):
+    temp_path: str
+    file_name: str
+    content_hash: str
+    size: int
+    source_path: str = None
+    mtime_ns: int = None
+
+
+def stage_content_file(full_path) -> StagedFile:
+    """
+    Copies a file into a temporary file in CONTENTS_ROOT, computing its SHA-256
+    and size during the copy so the source is only read once
+    :param full_path: path of the file to ingest
+    :return: StagedFile that must be passed to commit_staged_file or discard_staged_file
+    """
+    base_name = get_valid_filename(os.path.basename(full_path))
+    validate_unique_filename(File(None, base_name))
+    hash_sha256 = hashlib.sha256()
+    size = 0
+    fd, temp_path = tempfile.mkstemp(prefix=".ingest-", suffix=".part", dir=settings.CONTENTS_ROOT)
+    try:
+        with open(full_path, "rb") as source, os.fdopen(fd, "wb") as target:
+            source_stat = os.fstat(source.fileno())
+            for chunk in iter(lambda: source.read(COPY_CHUNK_SIZE), b""):
+                hash_sha256.update(chunk)
+                target.write(chunk)
+                size += len(chunk)
+        # mkstemp creates the file as 0600, match what FileField uploads get
+        if default_storage.file_permissions_mode is not None:
+            os.chmod(temp_path, default_storage.file_permissions_mode)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+    return StagedFile(temp_path, base_name, hash_sha256.hexdigest(), size,
+                      os.path.abspath(full_path), source_stat.st_mtime_ns)
+
+
+def hash_source_file(full_path) -> StagedFile:
+    """
+    Hashes a file without copying it
+    :return: StagedFile without a temporary file
+    """
+    with open(full_path, "rb") as source:
+        source_stat = os.fstat(source.fileno())
+        content_hash = sha256(source)
+    return StagedFile(None, get_valid_filename(os.path.basename(full_path)), content_hash,
+                      source_stat.st_size, os.path.abspath(full_path), source_stat.st_mtime_ns)
+
+
+def discard_staged_file(staged: StagedFile):
+    if staged.temp_path is not None and os.path.isfile(staged.temp_path):
+        os.remove(staged.temp_path)
+
+
+def commit_staged_file(staged: StagedFile, content: Content, pending_hashes: Dict[str, str] = None,
+                       existing_hashes: Dict[str, str] = None):
+    """
+    Rejects the staged file if it duplicates an existing file, otherwise links
+    it to its final name in CONTENTS_ROOT and points content at it.
+    Does not save content.
+    :param pending_hashes: hashes and file names of files committed for contents
+        that are not saved yet, the file's hash is added to it once committed
+    :param existing_hashes: hashes and file names of saved contents, looked up by the caller
+        for a batch of files, the database is queried for the file's hash when not given
+    """
+    try:
+        validate_unique_filename(File(None, staged.file_name))
+        if existing_hashes is None:
+            validate_unique_hash(staged.content_hash)
+        elif staged.content_hash in existing_hashes:
+            raise ValidationError('File already exists with name ' + str(existing_hashes[staged.content_hash]))
+        if pending_hashes is not None and staged.content_hash in pending_hashes:
+            raise ValidationError('File already exists with name ' + pending_hashes[staged.content_hash])
+        # unlike a rename, the link fails when another import or upload took the name since the check above
+        try:
+            os.link(staged.temp_path, os.path.join(settings.CONTENTS_ROOT, staged.file_name))
+        except FileExistsError:
+            raise ValidationError('Filename already exists.')
+    except ValidationError:
+        discard_staged_file(staged)
+        raise
+    os.remove(staged.temp_path)
+    if pending_hashes is not None:
+        pending_hashes[staged.content_hash] = staged.file_name
+    content.content_file.name = os.path.join("contents", staged.file_name)
+    content.file_name = staged.file_name
+    content.content_hash = staged.content_hash
+    content.filesize = staged.size
+
+
+# running hashes of chunked uploads, keyed by session id, as (bytes hashed, hash object)
+# only valid when every chunk of a session arrived at this process, otherwise the
+# assembled file is hashed once on finalize
+_upload_hashers = {}
+_upload_hashers_lock = threading.Lock()
+
+
+def append_upload_chunk(session: UploadSession, stream):
+    """
+    Writes a chunk of an upload session at session.received and saves the new offset
+    Anything after that offset, left by an interrupted chunk, is overwritten.
+    The caller must hold a lock on the session row, see UploadSessionViewSet.chunk
+    :param stream: file-like object with the chunk's bytes
+    """
+    path = session.part_path()
+    received = session.received
+    with _upload_hashers_lock:
+        cached = _upload_hashers.pop(session.id, None)
+    if cached is not None and cached[0] == received:
+        hasher = cached[1]
+    elif received == 0:
+        hasher = hashlib.sha256()
+    else:
+        hasher = None
+    with open(path, "r+b" if os.path.exists(path) else "wb") as part:
+        part.seek(received)
+        part.truncate()
+        if stream is not None:
+            for chunk in iter(lambda: stream.read(COPY_CHUNK_SIZE), b""):
+                if received + len(chunk) > session.total_size:
+                    raise ValidationError('Chunk extends past the end of the file')
+                part.write(chunk)
+                if hasher is not None:
+                    hasher.update(chunk)
+                received += len(chunk)
+    session.received = received
+    session.updated_on = timezone.now()
+    session.save(update_fields=['received', 'updated_on'])
+    if hasher is not None:
+        with _upload_hashers_lock:
+            _upload_hashers[session.id] = (received, hasher)
+
+
+def finalize_upload_session(session: UploadSession) -> StagedFile:
+    """
+    Checks that an upload session is complete and returns its file staged for commit_staged_file
+    """
+    if session.received != session.total_size:
+        raise ValidationError('Upload is incomplete')
+    path = session.part_path()
+    if not os.path.exists(path):
+        if session.total_size != 0:
+            raise ValidationError('Upload data lost, start a new upload session')
+        # empty files never receive a chunk
+        open(path, "wb").close()
+    with _upload_hashers_lock:
+        cached = _upload_hashers.pop(session.id, None)
+    if cached is not None and cached[0] == session.total_size:
+        content_hash = cached[1].hexdigest()
+    else:
+        with open(path, "rb") as part:
+            content_hash = sha256(part)
+    if session.expected_hash is not None and session.expected_hash != content_hash:
+        raise ValidationError('Uploaded file does not match expected_hash')
+    return StagedFile(path, session.file_name, content_hash, session.total_size)
+
+
+def expire_upload_sessions():
+    """
+    Deletes upload sessions that received no chunk for UPLOAD_SESSION_EXPIRY_HOURS, along with their partial files
+    :return: number of sessions deleted
+    """
+    expired = UploadSession.objects.filter(
+        updated_on__lt=timezone.now() - datetime.timedelta(hours=settings.UPLOAD_SESSION_EXPIRY_HOURS)
+    )
+    # deleted one by one so on_upload_session_delete removes each partial file
+    count = 0
+    for session in expired:
+        session.delete()
+        count += 1
+    return count
 
 
 class LibraryBuildUtil:
 
-    def build_library(self, version_id):
+    @staticmethod
+    def library_db_path(version_id):
+        return os.path.join(os.path.abspath(settings.BUILDS_ROOT), str(version_id), 'solarspell.db')
+
+    @staticmethod
+    def library_package_path(version_id):
+        return os.path.join(os.path.abspath(settings.BUILDS_ROOT), str(version_id), 'package')
+
+    @staticmethod
+    def library_delta_path(version_id, base_version_id):
+        return os.path.join(os.path.abspath(settings.BUILDS_ROOT), str(version_id), f'delta-{base_version_id}')
+
+    @staticmethod
+    def version_content_ids(version_id):
+        return LibraryFolder.library_content.through.objects \
+            .filter(libraryfolder__version_id=version_id).values('content_id')
+
+    def build_library(self, version_id, build_id=None, progress=None, bulk_load=True):
+        """
+        Writes the database of a library version to BUILDS_ROOT/<version_id>/solarspell.db
+        The database is written to a private temporary file first and renamed into place once complete,
+        so concurrent builds never share a file and readers never see a partial database
+        :param version_id: id of the LibraryVersion to build
+        :param build_id: id of the LibraryBuild, used to name the temporary file
+        :param progress: optional callable(table, rows_written), see LibraryDbUtil.insert_data
+        :param bulk_load: write with the unjournaled loader settings, safe since a failed build discards its file
+        :return: path of the database file
+        """
+        # contents in several folders of the version are matched once through semi-joins on these ids,
+        # so no query needs DISTINCT ON or joins back through the folders
+        version_content_ids = self.version_content_ids(version_id)
+        # a handful of ids, passed as a list since the planner misjudges a second semi-join
+        version_type_ids = list(LibraryVersion.metadata_types.through.objects
+                                .filter(libraryversion__id=version_id).values_list('metadatatype_id', flat=True))
+
         metadata_types = LibraryVersion.metadata_types.through.objects.filter(libraryversion__id=version_id) \
             .values_list('metadatatype_id', 'metadatatype__name')
-        metadata = Metadata.objects.filter(content__libraryfolder__version_id=version_id) \
-            .filter(type__pk__in=metadata_types.values_list('metadatatype_id')).values_list('id', 'name',
-                                                                                            'type__name',
-                                                                                            'type_id').distinct('id')
+        contents_metadata = Content.metadata.through.objects.filter(content_id__in=version_content_ids,
+                                                                    metadata__type_id__in=version_type_ids) \
+            .values_list('content_id', 'metadata_id')
+        metadata = Metadata.objects.filter(id__in=contents_metadata.values('metadata_id')) \
+            .values_list('id', 'name', 'type__name', 'type_id')
         folders = LibraryFolder.objects.filter(version_id=version_id).values_list('id', 'folder_name',
                                                                                   'logo_img__image_file', 'parent_id')
         modules = LibraryModule.objects.filter(libraryversion__id=version_id).values_list('id', 'module_name',
                                                                                           'logo_img__image_file')
-        contents = Content.objects.filter(libraryfolder__version_id=version_id).values_list('id', 'title', 'description'
-                                                                                            ,
-                                                                                            Substr('content_file', 10),
-                                                                                            'published_date',
-                                                                                            'copyright_notes',
-                                                                                            'rights_statement',
-                                                                                            'filesize') \
-            .distinct('id')
-        contents_metadata = Content.metadata.through.objects.filter(content__libraryfolder__version_id=version_id) \
-            .values_list('content_id', 'metadata_id')
+        contents = Content.objects.filter(id__in=version_content_ids).values_list('id', 'title', 'description',
+                                                                                 Substr('content_file', 10),
+                                                                                 'published_date',
+                                                                                 'copyright_notes',
+                                                                                 'rights_statement',
+                                                                                 'filesize')
         contents_folder = LibraryFolder.library_content.through.objects.filter(libraryfolder__version_id=version_id) \
-            .values_list('content_id', 'libraryfolder_id', 'libraryfolder__library_content__title', \
-                         'libraryfolder__library_content__filesize')
-        db_util = LibraryDbUtil(metadata_types, metadata, folders, modules, contents, contents_metadata,
-                                contents_folder)
-        db_util.create_library_db()
-        return 'success'
+            .values_list('content_id', 'libraryfolder_id', 'content__title', 'content__filesize')
+        metadata_stats = contents_metadata.order_by().values('metadata_id').annotate(content_count=Count('content_id')) \
+            .values_list('metadata_id', 'content_count')
+        db_util = LibraryDbUtil(*(
+            # server-side cursors, so only chunk_size rows of each query are held in memory at once
+            queryset.iterator(chunk_size=settings.BUILD_CHUNK_SIZE)
+            for queryset in (metadata_types, metadata, folders, modules, contents, contents_metadata, contents_folder)
+        ), folder_stats=[(folder['id'], folder['total_content_count'], folder['total_bytes'])
+                         for folder in LibraryVersionUtil().folder_summaries(version_id)],
+            metadata_stats=metadata_stats.iterator(chunk_size=settings.BUILD_CHUNK_SIZE),
+            progress=progress, bulk_load=bulk_load)
+
+        database = self.library_db_path(version_id)
+        os.makedirs(os.path.dirname(database), exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(prefix=f".build-{version_id}-{build_id}-", suffix=".db.part",
+                                         dir=os.path.dirname(database))
+        os.close(fd)
+        try:
+            db_util.create_library_db(temp_path)
+            if default_storage.file_permissions_mode is not None:
+                os.chmod(temp_path, default_storage.file_permissions_mode)
+            os.replace(temp_path, database)
+        except BaseException:
+            os.remove(temp_path)
+            raise
+        return database
+
+    def version_media_files(self, version_id):
+        """
+        Names, relative to MEDIA_ROOT, of every file a device needs for a library version:
+        content files, module files, folder and module logos and the banner
+        """
+        querysets = (
+            Content.objects.filter(id__in=self.version_content_ids(version_id)).values_list('content_file'),
+            LibraryModule.objects.filter(libraryversion__id=version_id).values_list('module_file',
+                                                                                   'logo_img__image_file'),
+            LibraryFolder.objects.filter(version_id=version_id).values_list('logo_img__image_file'),
+            LibraryVersion.objects.filter(id=version_id).values_list('library_banner__image_file'),
+        )
+        seen = set()
+        for queryset in querysets:
+            for names in queryset.iterator(chunk_size=settings.BUILD_CHUNK_SIZE):
+                for name in names:
+                    if name and name not in seen:
+                        seen.add(name)
+                        yield name
+
+    def stage_package(self, version_id, database, build_id=None, progress=None):
+        """
+        Assembles the deployable tree of a library version in BUILDS_ROOT/<version_id>/package:
+        solarspell.db at the top and every media file at its path relative to MEDIA_ROOT.
+        Files are hardlinked, or reflinked, from MEDIA_ROOT, so staging takes no extra space and
+        is only as slow as creating the directory entries; they are copied only when neither works.
+        Hardlinks are safe because content files are replaced, never rewritten in place
+        :param version_id: id of the LibraryVersion to package
+        :param database: path of the version's built database
+        :param build_id: id of the LibraryBuild, used to name the staging directory
+        :param progress: optional callable('package', files_staged), called before and after staging
+        :return: path of the package directory
+        """
+        package = self.library_package_path(version_id)
+        staging = tempfile.mkdtemp(prefix=f".package-{version_id}-{build_id}-", dir=os.path.dirname(package))
+        if progress is not None:
+            progress('package', None)
+        try:
+            link_file(database, os.path.join(staging, 'solarspell.db'))
+            file_count = 1
+            for name in self.version_media_files(version_id):
+                destination = os.path.join(staging, name)
+                os.makedirs(os.path.dirname(destination), exist_ok=True)
+                link_file(default_storage.path(name), destination)
+                file_count += 1
+
+            # the previous package is moved aside first since a directory cannot be replaced while it has entries
+            if os.path.isdir(package):
+                os.replace(package, staging + '.old')
+            os.replace(staging, package)
+            shutil.rmtree(staging + '.old', ignore_errors=True)
+        except BaseException:
+            shutil.rmtree(staging, ignore_errors=True)
+            raise
+        if progress is not None:
+            progress('package', file_count)
+        return package
+
+
+    def version_file_hashes(self, version_id):
+        """
+        SHA-256 of every file a device needs for a library version, keyed by name relative to MEDIA_ROOT
+        Content files use their stored hash, other files, and contents not hashed yet, are read
+        """
+        content_hashes = dict(
+            Content.objects.filter(id__in=self.version_content_ids(version_id), content_hash__isnull=False)
+            .values_list('content_file', 'content_hash').iterator(chunk_size=settings.BUILD_CHUNK_SIZE)
+        )
+        file_hashes = {}
+        for name in self.version_media_files(version_id):
+            if name in content_hashes:
+                file_hashes[name] = content_hashes[name]
+            else:
+                with default_storage.open(name, "rb") as media_file:
+                    file_hashes[name] = sha256(media_file)
+        return file_hashes
+
+    def stage_delta(self, version_id, base_version_id, database, build_id=None, progress=None):
+        """
+        Assembles an update from base_version_id to version_id in BUILDS_ROOT/<version_id>/delta-<base_version_id>.
+        A device applies it by deleting the paths listed in removed.txt, copying files/ over its library
+        and running patch.sql against its solarspell.db; delta.json summarizes the changes
+        Files are compared by content hash, so a file is only shipped when it is new or its bytes changed.
+        The base version is built first if it has no database yet
+        :param version_id: id of the LibraryVersion to update to
+        :param base_version_id: id of the LibraryVersion the devices have
+        :param database: path of the version's built database
+        :param build_id: id of the LibraryBuild, used to name the staging directory
+        :param progress: optional callable('delta', files_staged), called before and after staging
+        :return: path of the delta directory
+        """
+        base_database = self.library_db_path(base_version_id)
+        if not os.path.isfile(base_database):
+            self.build_library(base_version_id, build_id)
+
+        delta = self.library_delta_path(version_id, base_version_id)
+        staging = tempfile.mkdtemp(prefix=f".delta-{version_id}-{build_id}-", dir=os.path.dirname(delta))
+        if progress is not None:
+            progress('delta', None)
+        try:
+            base_hashes = self.version_file_hashes(base_version_id)
+            file_hashes = self.version_file_hashes(version_id)
+            added = sorted(name for name, file_hash in file_hashes.items() if base_hashes.get(name) != file_hash)
+            removed = sorted(name for name in base_hashes if name not in file_hashes)
+
+            added_bytes = 0
+            for name in added:
+                destination = os.path.join(staging, 'files', name)
+                os.makedirs(os.path.dirname(destination), exist_ok=True)
+                link_file(default_storage.path(name), destination)
+                added_bytes += os.path.getsize(destination)
+            with open(os.path.join(staging, 'removed.txt'), 'w') as removed_file:
+                removed_file.writelines(name + '\n' for name in removed)
+            with open(os.path.join(staging, 'patch.sql'), 'w') as patch_file:
+                row_counts = write_sql_patch(base_database, database, patch_file)
+            with open(os.path.join(staging, 'delta.json'), 'w') as summary_file:
+                json.dump({
+                    'base_version': base_version_id,
+                    'version': version_id,
+                    'added_files': len(added),
+                    'added_bytes': added_bytes,
+                    'removed_files': len(removed),
+                    'rows': {table: {'deleted': deleted, 'inserted': inserted}
+                             for table, (deleted, inserted) in row_counts.items()},
+                }, summary_file, indent=2)
+
+            if os.path.isdir(delta):
+                os.replace(delta, staging + '.old')
+            os.replace(staging, delta)
+            shutil.rmtree(staging + '.old', ignore_errors=True)
+        except BaseException:
+            shutil.rmtree(staging, ignore_errors=True)
+            raise
+        if progress is not None:
+            progress('delta', len(added))
+        return delta
+
+
+# ioctl that makes a file share the blocks of another on copy on write filesystems such as btrfs and XFS
+FICLONE = 0x40049409
+
+try:
+    import fcntl
+except ImportError:
+    # Windows, where files that cannot be hardlinked are copied
+    fcntl = None
+
+
+def link_file(source, destination):
+    """
+    Makes destination a hardlink to source, a reflink when hardlinks are not possible,
+    or a copy when source is on another filesystem that does not support either
+    :return: 'link', 'reflink' or 'copy'
+    """
+    try:
+        os.link(source, destination)
+        return 'link'
+    except OSError as e:
+        if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP):
+            raise
+    with open(source, "rb") as source_file, open(destination, "wb") as destination_file:
+        if fcntl is not None:
+            try:
+                fcntl.ioctl(destination_file.fileno(), FICLONE, source_file.fileno())
+                return 'reflink'
+            except OSError:
+                pass
+        shutil.copyfileobj(source_file, destination_file, COPY_CHUNK_SIZE)
+        return 'copy'
+
+
+def iter_tar_stream(directory):
+    """
+    Streams an uncompressed tar of directory without building it on disk or in memory,
+    file contents are read in COPY_CHUNK_SIZE chunks as the archive is consumed
+    :param directory: directory to archive, its entries are named relative to it
+    :return: generator of bytes
+    """
+    for root, dirs, files in os.walk(directory):
+        dirs.sort()
+        for name in sorted(files):
+            path = os.path.join(root, name)
+            stat = os.stat(path)
+            info = tarfile.TarInfo(os.path.relpath(path, directory))
+            info.size = stat.st_size
+            info.mtime = stat.st_mtime
+            info.mode = 0o644
+            # PAX headers allow long names and files over 8 GiB
+            yield info.tobuf(tarfile.PAX_FORMAT)
+            with open(path, "rb") as file:
+                for chunk in iter(lambda: file.read(COPY_CHUNK_SIZE), b""):
+                    yield chunk
+            if info.size % tarfile.BLOCKSIZE:
+                yield tarfile.NUL * (tarfile.BLOCKSIZE - info.size % tarfile.BLOCKSIZE)
+    yield tarfile.NUL * (tarfile.BLOCKSIZE * 2)
+
+
+def change_folder_contents(changes):
+    """
+    Adds and removes the contents of any number of folders with one validation query per model,
+    one bulk insert and one bulk delete, in one transaction
+    :param changes: iterable of (folder id, content ids to add, content ids to remove)
+    :raises ValidationError: when the content ids are not lists of numbers or an id does not exist,
+        nothing is changed then
+    :return: dict with the number of folder contents added and removed
+    """
+    changes = list(changes)
+    for _, add, remove in changes:
+        # a string would otherwise be read one digit at a time
+        if not all(isinstance(ids, list) and all(type(content_id) is int for content_id in ids)
+                   for ids in (add, remove)):
+            raise ValidationError('Content ids must be lists of numbers')
+    try:
+        additions = [(int(folder_id), content_id) for folder_id, add, _ in changes for content_id in add]
+        removals = [(int(folder_id), content_id) for folder_id, _, remove in changes for content_id in remove]
+    except (TypeError, ValueError):
+        raise ValidationError('Folder ids must be numbers')
+
+    folder_ids = {folder_id for folder_id, _ in additions + removals}
+    missing_folders = folder_ids - set(LibraryFolder.objects.filter(id__in=folder_ids).values_list('id', flat=True))
+    if missing_folders:
+        raise ValidationError('Folders not found: ' + ', '.join(str(i) for i in sorted(missing_folders)))
+    content_ids = {content_id for _, content_id in additions}
+    missing_contents = content_ids - set(Content.objects.filter(id__in=content_ids).values_list('id', flat=True))
+    if missing_contents:
+        raise ValidationError('Contents not found: ' + ', '.join(str(i) for i in sorted(missing_contents)))
+
+    folder_content_table = LibraryFolder.library_content.through._meta.db_table
+    removed_count = added_count = 0
+    with transaction.atomic(), connection.cursor() as cursor:
+        if removals:
+            cursor.execute(f"""
+                DELETE FROM {folder_content_table}
+                WHERE (libraryfolder_id, content_id) IN (SELECT * FROM unnest(%s::integer[], %s::integer[]))
+            """, [[folder_id for folder_id, _ in removals], [content_id for _, content_id in removals]])
+            removed_count = cursor.rowcount
+        if additions:
+            cursor.execute(f"""
+                INSERT INTO {folder_content_table} (libraryfolder_id, content_id)
+                SELECT DISTINCT * FROM unnest(%s::integer[], %s::integer[])
+                ON CONFLICT DO NOTHING
+            """, [[folder_id for folder_id, _ in additions], [content_id for _, content_id in additions]])
+            added_count = cursor.rowcount
+    return {'added_count': added_count, 'removed_count': removed_count}
+
+
+# Nominal capacities of the SD cards libraries are shipped on, in bytes
+CARD_SIZES = (128 * 10 ** 9, 256 * 10 ** 9)
+
+
+class LibraryVersionUtil:
+
+    @transaction.atomic
+    def clone_version(self, version_id):
+        """
+        Copies a library version with its modules and whole folder tree under a new version number.
+        Folders are created with one bulk insert per tree level, parents first so their new ids are known,
+        followed by one update of their paths, and the folder contents are copied in one INSERT ... SELECT, all in one transaction
+        :param version_id: id of the LibraryVersion to clone
+        :return: the new LibraryVersion
+        """
+        version = LibraryVersion.objects.get(id=version_id)
+        modules = list(version.library_modules.all())
+
+        version.id = None
+        i = 0
+        new_number = version.version_number + str(i)
+        while LibraryVersion.objects.filter(version_number=new_number).exists():
+            i += 1
+            new_number = version.version_number + str(i)
+        version.version_number = new_number
+        version.save()
+        version.library_modules.set(modules)
+
+        children = {}
+        for folder in LibraryFolder.objects.filter(version_id=version_id).values('id', 'folder_name', 'logo_img_id',
+                                                                                 'parent_id', 'origin_id'):
+            children.setdefault(folder['parent_id'], []).append(folder)
+
+        new_ids = {}
+        new_paths = {}
+        level = children.get(None, [])
+        while level:
+            created = LibraryFolder.objects.bulk_create([
+                LibraryFolder(folder_name=folder['folder_name'], logo_img_id=folder['logo_img_id'], version=version,
+                              parent_id=new_ids.get(folder['parent_id']), origin_id=folder['origin_id'])
+                for folder in level
+            ])
+            for folder, new_folder in zip(level, created):
+                new_ids[folder['id']] = new_folder.id
+                new_paths[new_folder.id] = new_paths.get(new_folder.parent_id, '/') + f'{new_folder.id}/'
+                new_folder.path = new_paths[new_folder.id]
+            LibraryFolder.objects.bulk_update(created, ['path'])
+            level = [child for folder in level for child in children.get(folder['id'], [])]
+
+        if new_ids:
+            folder_content_table = LibraryFolder.library_content.through._meta.db_table
+            with connection.cursor() as cursor:
+                cursor.execute(f"""
+                    INSERT INTO {folder_content_table} (libraryfolder_id, content_id)
+                    SELECT folder_map.new_id, folder_content.content_id
+                    FROM {folder_content_table} folder_content
+                    JOIN unnest(%s::integer[], %s::integer[]) AS folder_map (old_id, new_id)
+                        ON folder_map.old_id = folder_content.libraryfolder_id
+                """, [list(new_ids.keys()), list(new_ids.values())])
+        return version
+
+    def folder_summaries(self, version_id):
+        """
+        Every folder of a version with the number and total size of its own contents, and of the distinct
+        contents in it and all its subfolders, from one recursive query pairing every folder with each of its ancestors
+        :param version_id: id of the LibraryVersion
+        :return: list of dicts ordered by folder id
+        """
+        folder_table = LibraryFolder._meta.db_table
+        folder_content_table = LibraryFolder.library_content.through._meta.db_table
+        with connection.cursor() as cursor:
+            cursor.execute(f"""
+                WITH RECURSIVE closure (ancestor_id, folder_id) AS (
+                    SELECT id, id FROM {folder_table} WHERE version_id = %(version_id)s
+                  UNION ALL
+                    SELECT closure.ancestor_id, child.id FROM {folder_table} child
+                    JOIN closure ON child.parent_id = closure.folder_id
+                ), placed AS (
+                    SELECT DISTINCT closure.ancestor_id, folder_content.content_id
+                    FROM closure
+                    JOIN {folder_content_table} folder_content ON folder_content.libraryfolder_id = closure.folder_id
+                ), totals AS (
+                    SELECT placed.ancestor_id AS folder_id, COUNT(*) AS content_count, SUM(content.filesize) AS bytes
+                    FROM placed JOIN {Content._meta.db_table} content ON content.id = placed.content_id
+                    GROUP BY placed.ancestor_id
+                ), own AS (
+                    SELECT folder_content.libraryfolder_id AS folder_id, COUNT(*) AS content_count,
+                           SUM(content.filesize) AS bytes
+                    FROM {folder_content_table} folder_content
+                    JOIN {Content._meta.db_table} content ON content.id = folder_content.content_id
+                    WHERE folder_content.libraryfolder_id IN (
+                        SELECT id FROM {folder_table} WHERE version_id = %(version_id)s
+                    )
+                    GROUP BY folder_content.libraryfolder_id
+                )
+                SELECT folder.id, folder.folder_name, folder.parent_id, folder.logo_img_id,
+                       COALESCE(own.content_count, 0), COALESCE(own.bytes, 0),
+                       COALESCE(totals.content_count, 0), COALESCE(totals.bytes, 0)
+                FROM {folder_table} folder
+                LEFT JOIN own ON own.folder_id = folder.id
+                LEFT JOIN totals ON totals.folder_id = folder.id
+                WHERE folder.version_id = %(version_id)s
+                ORDER BY folder.id
+            """, {'version_id': version_id})
+            return [{
+                'id': folder_id,
+                'folder_name': folder_name,
+                'parent': parent_id,
+                'logo_img': logo_img_id,
+                'content_count': content_count,
+                'content_bytes': content_bytes,
+                'total_content_count': total_content_count,
+                'total_bytes': total_bytes,
+            } for (folder_id, folder_name, parent_id, logo_img_id, content_count, content_bytes,
+                   total_content_count, total_bytes) in cursor.fetchall()]
+
+    def folder_tree(self, version_id):
+        """
+        The nested folder tree of a version, assembled in memory from folder_summaries
+        :param version_id: id of the LibraryVersion
+        :return: list of top level folders, each with a list of subfolders
+        """
+        folders = self.folder_summaries(version_id)
+        children = {}
+        for folder in folders:
+            folder['subfolders'] = children.setdefault(folder['id'], [])
+        roots = []
+        for folder in folders:
+            siblings = roots if folder['parent'] is None else children[folder['parent']]
+            siblings.append(folder)
+        return roots
+
+    def capacity(self, version_id):
+        """
+        Space a library version needs on a card, from one recursive query over its folder tree.
+        A content placed in several folders is counted once in the totals, and once in each top level folder
+        :param version_id: id of the LibraryVersion
+        :return: dict of content and module totals, sizes per top level folder and which cards it fits on
+        """
+        with connection.cursor() as cursor:
+            cursor.execute(f"""
+                WITH RECURSIVE subtree (folder_id, top_id) AS (
+                    SELECT id, id FROM {LibraryFolder._meta.db_table}
+                    WHERE version_id = %(version_id)s AND parent_id IS NULL
+                  UNION ALL
+                    SELECT child.id, subtree.top_id FROM {LibraryFolder._meta.db_table} child
+                    JOIN subtree ON child.parent_id = subtree.folder_id
+                ), placed AS (
+                    SELECT DISTINCT subtree.top_id, folder_content.content_id
+                    FROM subtree
+                    JOIN {LibraryFolder.library_content.through._meta.db_table} folder_content
+                        ON folder_content.libraryfolder_id = subtree.folder_id
+                ), ranked AS (
+                    SELECT placed.top_id, content.filesize,
+                           row_number() OVER (PARTITION BY content.id) = 1 AS first_placement
+                    FROM placed JOIN {Content._meta.db_table} content ON content.id = placed.content_id
+                ), totals AS (
+                    SELECT top_id,
+                           CASE WHEN GROUPING(top_id) = 1 THEN COUNT(*) FILTER (WHERE first_placement)
+                                ELSE COUNT(*) END AS file_count,
+                           CASE WHEN GROUPING(top_id) = 1 THEN SUM(filesize) FILTER (WHERE first_placement)
+                                ELSE SUM(filesize) END AS bytes,
+                           COUNT(*) FILTER (WHERE first_placement AND filesize IS NULL) AS unsized_count
+                    FROM ranked GROUP BY GROUPING SETS ((top_id), ())
+                )
+                SELECT roots.id, roots.folder_name, totals.file_count, totals.bytes, totals.unsized_count
+                FROM totals FULL OUTER JOIN (
+                    SELECT id, folder_name FROM {LibraryFolder._meta.db_table}
+                    WHERE version_id = %(version_id)s AND parent_id IS NULL
+                ) roots ON roots.id = totals.top_id
+                ORDER BY roots.id
+            """, {'version_id': version_id})
+            rows = cursor.fetchall()
+
+        folders = []
+        total = None
+        for folder_id, folder_name, file_count, total_bytes, unsized_count in rows:
+            if folder_id is None:
+                total = {'file_count': file_count, 'bytes': total_bytes or 0, 'unsized_count': unsized_count}
+            else:
+                folders.append({'id': folder_id, 'folder_name': folder_name, 'file_count': file_count or 0,
+                                'bytes': total_bytes or 0})
+
+        module_bytes = 0
+        for module in LibraryModule.objects.filter(libraryversion__id=version_id).only('module_file'):
+            if module.module_file and os.path.isfile(module.module_file.path):
+                module_bytes += os.path.getsize(module.module_file.path)
+
+        total_bytes = total['bytes'] + module_bytes
+        return {
+            'content_bytes': total['bytes'],
+            'content_count': total['file_count'],
+            'unsized_content_count': total['unsized_count'],
+            'module_bytes': module_bytes,
+            'total_bytes': total_bytes,
+            'folders': folders,
+            'cards': [{'size': size, 'fits': total_bytes <= size} for size in CARD_SIZES],
+        }
+
+    def diff_versions(self, base_version_id, version_id):
+        """
+        Differences between two library versions, worked out in SQL by matching folders on origin_id,
+        so folders of a clone line up with the ones they were cloned from even after being moved or renamed.
+        Content changes come from EXCEPT between the (folder, content) pairs of each version
+        :param base_version_id: id of the LibraryVersion compared against
+        :param version_id: id of the LibraryVersion being compared
+        :return: dict of added, removed, moved and renamed folders, content changes per folder and size totals
+        """
+        folder_table = LibraryFolder._meta.db_table
+        folder_content_table = LibraryFolder.library_content.through._meta.db_table
+        params = {'base_version_id': base_version_id, 'version_id': version_id}
+        with connection.cursor() as cursor:
+            cursor.execute(f"""
+                WITH base AS (
+                    SELECT folder.id, folder.origin_id, folder.folder_name, folder.parent_id,
+                           parent.origin_id AS parent_origin_id
+                    FROM {folder_table} folder LEFT JOIN {folder_table} parent ON parent.id = folder.parent_id
+                    WHERE folder.version_id = %(base_version_id)s
+                ), other AS (
+                    SELECT folder.id, folder.origin_id, folder.folder_name, folder.parent_id,
+                           parent.origin_id AS parent_origin_id
+                    FROM {folder_table} folder LEFT JOIN {folder_table} parent ON parent.id = folder.parent_id
+                    WHERE folder.version_id = %(version_id)s
+                )
+                SELECT base.id, base.folder_name, base.parent_id, other.id, other.folder_name, other.parent_id,
+                       base.parent_origin_id IS DISTINCT FROM other.parent_origin_id
+                FROM base FULL OUTER JOIN other ON other.origin_id = base.origin_id
+                WHERE base.id IS NULL OR other.id IS NULL
+                   OR base.parent_origin_id IS DISTINCT FROM other.parent_origin_id
+                   OR base.folder_name <> other.folder_name
+                ORDER BY other.id, base.id
+            """, params)
+            folder_rows = cursor.fetchall()
+
+            cursor.execute(f"""
+                WITH base AS (
+                    SELECT folder.origin_id, folder_content.content_id
+                    FROM {folder_content_table} folder_content
+                    JOIN {folder_table} folder ON folder.id = folder_content.libraryfolder_id
+                    WHERE folder.version_id = %(base_version_id)s
+                ), other AS (
+                    SELECT folder.origin_id, folder_content.content_id
+                    FROM {folder_content_table} folder_content
+                    JOIN {folder_table} folder ON folder.id = folder_content.libraryfolder_id
+                    WHERE folder.version_id = %(version_id)s
+                ), changes AS (
+                    SELECT origin_id, content_id, TRUE AS added FROM (SELECT * FROM other EXCEPT SELECT * FROM base) a
+                  UNION ALL
+                    SELECT origin_id, content_id, FALSE FROM (SELECT * FROM base EXCEPT SELECT * FROM other) r
+                )
+                SELECT other_folder.id, base_folder.id, changes.content_id, changes.added
+                FROM changes
+                LEFT JOIN {folder_table} base_folder
+                    ON base_folder.origin_id = changes.origin_id AND base_folder.version_id = %(base_version_id)s
+                LEFT JOIN {folder_table} other_folder
+                    ON other_folder.origin_id = changes.origin_id AND other_folder.version_id = %(version_id)s
+                ORDER BY other_folder.id, base_folder.id, changes.content_id
+            """, params)
+            content_rows = cursor.fetchall()
+
+            cursor.execute(f"""
+                WITH base AS (
+                    SELECT DISTINCT folder_content.content_id
+                    FROM {folder_content_table} folder_content
+                    JOIN {folder_table} folder ON folder.id = folder_content.libraryfolder_id
+                    WHERE folder.version_id = %(base_version_id)s
+                ), other AS (
+                    SELECT DISTINCT folder_content.content_id
+                    FROM {folder_content_table} folder_content
+                    JOIN {folder_table} folder ON folder.id = folder_content.libraryfolder_id
+                    WHERE folder.version_id = %(version_id)s
+                ), added AS (
+                    SELECT * FROM other EXCEPT SELECT * FROM base
+                ), removed AS (
+                    SELECT * FROM base EXCEPT SELECT * FROM other
+                )
+                SELECT
+                    (SELECT COALESCE(SUM(filesize), 0) FROM {Content._meta.db_table} WHERE id IN (SELECT * FROM base)),
+                    (SELECT COALESCE(SUM(filesize), 0) FROM {Content._meta.db_table} WHERE id IN (SELECT * FROM other)),
+                    (SELECT COUNT(*) FROM added),
+                    (SELECT COALESCE(SUM(filesize), 0) FROM {Content._meta.db_table} WHERE id IN (SELECT * FROM added)),
+                    (SELECT COUNT(*) FROM removed),
+                    (SELECT COALESCE(SUM(filesize), 0) FROM {Content._meta.db_table} WHERE id IN (SELECT * FROM removed))
+            """, params)
+            base_bytes, other_bytes, added_count, added_bytes, removed_count, removed_bytes = cursor.fetchone()
+
+        folders = {'added': [], 'removed': [], 'moved': [], 'renamed': []}
+        for base_id, base_name, base_parent, other_id, other_name, other_parent, moved in folder_rows:
+            if base_id is None:
+                folders['added'].append({'id': other_id, 'folder_name': other_name, 'parent': other_parent})
+            elif other_id is None:
+                folders['removed'].append({'id': base_id, 'folder_name': base_name, 'parent': base_parent})
+            else:
+                if moved:
+                    folders['moved'].append({'id': other_id, 'base_id': base_id, 'folder_name': other_name,
+                                             'parent': other_parent, 'base_parent': base_parent})
+                if base_name != other_name:
+                    folders['renamed'].append({'id': other_id, 'base_id': base_id, 'folder_name': other_name,
+                                               'base_folder_name': base_name})
+
+        contents = []
+        for other_id, base_id, content_id, added in content_rows:
+            if not contents or (contents[-1]['id'], contents[-1]['base_id']) != (other_id, base_id):
+                contents.append({'id': other_id, 'base_id': base_id, 'added': [], 'removed': []})
+            contents[-1]['added' if added else 'removed'].append(content_id)
+
+        return {
+            'base_version': base_version_id,
+            'version': version_id,
+            'folders': folders,
+            'contents': contents,
+            'added_content_count': added_count,
+            'added_bytes': added_bytes,
+            'removed_content_count': removed_count,
+            'removed_bytes': removed_bytes,
+            'base_bytes': base_bytes,
+            'bytes': other_bytes,
+            'size_delta': other_bytes - base_bytes,
+        }
 
 
 def sha256(bytestream):
@@ -1,5 +1,4 @@
 import os
-import filecmp
 from django.core.exceptions import ValidationError
 from django.utils.text import get_valid_filename
 
@@ -10,13 +9,21 @@ def validate_unique_filename(value):
     if os.path.isfile(filepath):
         raise ValidationError('Filename already exists.')
 
+def validate_unique_hash(content_hash):
+    """
+    Raises a ValidationError if a Content with the given SHA-256 already exists
+    Uses the indexed content_hash column instead of rehashing CONTENTS_ROOT
+    """
+    from content_management.models import Content
+    duplicate = Content.objects.filter(content_hash=content_hash).only('file_name').first()
+    if duplicate is not None:
+        raise ValidationError('File already exists with name ' + str(duplicate.file_name))
+
 def validate_unique_file(value):
     from content_management.utils import sha256
-    files = [
-        os.path.join(settings.CONTENTS_ROOT, filename) for filename
-        in os.listdir(os.path.join(settings.CONTENTS_ROOT))
-    ]
-    for f in files:
-        if os.path.getsize(f) == value.size:
-            if sha256(open(f, "rb")) == sha256(value.file):
-                raise ValidationError('File already exists with name ' + os.path.basename(f))
\ No newline at end of file
+    value.file.seek(0)
+    content_hash = sha256(value.file)
+    value.file.seek(0)
+    validate_unique_hash(content_hash)
+    # kept on the upload so Content.set_file_name does not hash it again
+    value.content_hash = content_hash
@@ -1,26 +1,34 @@
-from rest_framework import viewsets, permissions, views
+from rest_framework import viewsets, permissions, views, mixins
 from rest_framework import status
 from rest_framework.response import Response
 from rest_framework.decorators import action, api_view, renderer_classes
 from content_management.models import (
     Content, Metadata, MetadataType, LibLayoutImage, LibraryVersion,
     LibraryFolder, User,
-    LibraryModule)
-from content_management.utils import ContentSheetUtil, LibraryBuildUtil
+    LibraryModule, ImportJob, UploadSession, LibraryBuild)
+from content_management.utils import (
+    append_upload_chunk, finalize_upload_session, commit_staged_file, iter_tar_stream, LibraryVersionUtil,
+    change_folder_contents)
 
 from content_management.serializers import ContentSerializer, MetadataSerializer, MetadataTypeSerializer, \
-    LibLayoutImageSerializer, LibraryVersionSerializer, LibraryFolderSerializer, UserSerializer, LibraryModuleSerializer
+    LibLayoutImageSerializer, LibraryVersionSerializer, LibraryFolderSerializer, UserSerializer, LibraryModuleSerializer, \
+    ImportJobSerializer, UploadSessionSerializer, UploadedContentSerializer, LibraryBuildSerializer
 
 from content_management.standardize_format import build_response
 from content_management.paginators import PageNumberSizePagination
 
 from django.db.models import Q
-from django.db import IntegrityError
+from django.db import IntegrityError, transaction
+from django.core.exceptions import ValidationError
 
-from django.http import HttpResponse
+from django.http import HttpResponse, FileResponse, StreamingHttpResponse
+from django.core.files import File
+from django.core.files.base import ContentFile
 from django.contrib.admin.views.decorators import staff_member_required
 
 import csv
+import json
+import os
 from rest_framework.generics import get_object_or_404
 from rest_framework.renderers import JSONRenderer
 import xlsxwriter
@@ -73,7 +81,8 @@ class StandardDataView:
 
 # Content ViewSet
 class ContentViewSet(StandardDataView, viewsets.ModelViewSet):
-    queryset = Content.objects.all()
+    # metadata_info reads every metadata with its type, so both come in one prefetch per page
+    queryset = Content.objects.prefetch_related("metadata__type")
     serializer_class = ContentSerializer
     pagination_class = PageNumberSizePagination
 
@@ -262,7 +271,7 @@ class UserViewSet(StandardDataView, viewsets.ModelViewSet):
     serializer_class = UserSerializer
 
 class LibraryVersionViewSet(StandardDataView, viewsets.ModelViewSet):
-    queryset = LibraryVersion.objects.all()
+    queryset = LibraryVersion.objects.select_related("created_by").prefetch_related("library_modules", "metadata_types")
     serializer_class = LibraryVersionSerializer
     folder_serializer = LibraryFolderSerializer
     pagination_class = PageNumberSizePagination
@@ -309,7 +318,7 @@ class LibraryVersionViewSet(StandardDataView, viewsets.ModelViewSet):
     @action(methods=['get'], detail=True)
     def root(self, request, pk=None):
         return build_response(LibraryFolderSerializer(
-                LibraryFolder.objects.filter(version=pk, parent=None).order_by("id"),
+                LibraryFolderViewSet.queryset.filter(version=pk, parent=None).order_by("id"),
                 many=True
             ).data if pk != None else []
         )
@@ -317,10 +326,33 @@ class LibraryVersionViewSet(StandardDataView, viewsets.ModelViewSet):
     @action(methods=['get'], detail=True)
     def folders(self, request, pk=None):
         return build_response(LibraryFolderSerializer(
-            LibraryFolder.objects.filter(version=pk).order_by("id"),
+            LibraryFolderViewSet.queryset.filter(version=pk).order_by("id"),
             many=True
         ).data if pk != None else [])
 
+    @action(methods=['get'], detail=True)
+    def tree(self, request, pk=None):
+        version = get_object_or_404(LibraryVersion, id=pk)
+        return build_response(LibraryVersionUtil().folder_tree(version.id))
+
+    @action(methods=['get'], detail=True)
+    def capacity(self, request, pk=None):
+        version = get_object_or_404(LibraryVersion, id=pk)
+        return build_response(LibraryVersionUtil().capacity(version.id))
+
+    @action(methods=['get'], detail=True)
+    def diff(self, request, pk=None):
+        version = get_object_or_404(LibraryVersion, id=pk)
+        try:
+            base_version = get_object_or_404(LibraryVersion, id=int(request.query_params.get("base", "")))
+        except ValueError:
+            return build_response(
+                status=status.HTTP_400_BAD_REQUEST,
+                success=False,
+                error="No base Version ID supplied"
+            )
+        return build_response(LibraryVersionUtil().diff_versions(base_version.id, version.id))
+
     @action(methods=['get'], detail=True)
     def modules(self, request, pk=None):
         return build_response(LibraryModuleSerializer(
@@ -380,55 +412,31 @@ class LibraryVersionViewSet(StandardDataView, viewsets.ModelViewSet):
                 error="No Folder ID supplied"
                 )
         
-        version_to_clone = get_object_or_404(LibraryVersion, id=pk)
-        modules = version_to_clone.library_modules.all()
-
-        #clone version
-        version_to_clone.id = None
-
-        i = 0
-        new_number = version_to_clone.version_number + str(i)
-        while LibraryVersion.objects.filter(version_number=new_number).exists():
-            i += 1
-            new_number = version_to_clone.version_number + str(i)
-
-
-        version_to_clone.version_number = new_number
-        version_to_clone.save()
-        
-        version_to_clone.library_modules.set(modules)
-        version_to_clone.save()
-
-
-        def clone_recursively(folder_to_clone, new_parent):
-            #save relationships of the old folder
-            subfolders = folder_to_clone.subfolders.all()
-            library_content = folder_to_clone.library_content.all()
-            
-            #clone subfolder
-            folder_to_clone.id = None
-            folder_to_clone.save()
-            folder_to_clone.parent = new_parent
-            folder_to_clone.version = version_to_clone
-            folder_to_clone.library_content.set(library_content)
-            folder_to_clone.save()
-            
-            for child in subfolders:
-                clone_recursively(child, folder_to_clone)
-        
-        [
-            clone_recursively(top_level_folder, None) for top_level_folder
-            in LibraryFolder.objects.filter(parent=None, version_id=pk)
-        ]
-
-        return build_response(LibraryVersionSerializer(version_to_clone).data)
+        get_object_or_404(LibraryVersion, id=pk)
+        return build_response(LibraryVersionSerializer(LibraryVersionUtil().clone_version(pk)).data)
 
 
 
 class LibraryFolderViewSet(StandardDataView, viewsets.ModelViewSet):
-    queryset = LibraryFolder.objects.all()
+    queryset = LibraryFolder.objects.prefetch_related("library_content")
     serializer_class = LibraryFolderSerializer
 
+    def perform_destroy(self, instance):
+        if not instance.path:
+            # subfolders are still collected level by level through parent
+            instance.delete()
+            return
+        # the whole subtree is collected by one prefix query instead of level by level through parent
+        instance.subtree().delete()
+
+    @action(methods=['get'], detail=True)
+    def descendants(self, request, pk=None):
+        folder = self.get_object()
+        return build_response(self.get_serializer(
+            folder.subtree().exclude(id=folder.id).prefetch_related("library_content").order_by("path"),
+            many=True
+        ).data)
+
     @action(methods=['get'], detail=True)
     def contents(self, request, pk=None):
         if pk is None:
@@ -445,7 +453,7 @@ class LibraryFolderViewSet(StandardDataView, viewsets.ModelViewSet):
                         many=True
                     ).data,
                     "files": ContentSerializer(
-                        self.get_queryset().get(id=pk).library_content,
+                        ContentViewSet.queryset.filter(libraryfolder=pk).order_by("id"),
                         many=True
                     ).data
                 }
@@ -467,11 +475,12 @@ class LibraryFolderViewSet(StandardDataView, viewsets.ModelViewSet):
                 error="No Content ID supplied"
             )
         
-        folder = self.get_queryset().get(id=pk)
-        for content_id in content_ids:
-            folder.library_content.add(
-                Content.objects.get(id=content_id)
-            )
+        # the viewset queryset would prefetch every content of the folder
+        folder = get_object_or_404(LibraryFolder.objects.only("id"), id=pk)
+        try:
+            change_folder_contents([(folder.id, content_ids, [])])
+        except ValidationError as e:
+            return build_response(status=status.HTTP_400_BAD_REQUEST, success=False, error=e.messages)
 
         return build_response()
     
@@ -492,38 +501,286 @@ class LibraryFolderViewSet(StandardDataView, viewsets.ModelViewSet):
                 error="No Content ID supplied"
             )
         
-        folder = self.get_queryset().get(id=pk)
-        for content_id in content_ids:
-            folder.library_content.remove(
-                Content.objects.get(id=content_id)
-            )
+        folder = get_object_or_404(LibraryFolder.objects.only("id"), id=pk)
+        try:
+            change_folder_contents([(folder.id, [], content_ids)])
+        except ValidationError as e:
+            return build_response(status=status.HTTP_400_BAD_REQUEST, success=False, error=e.messages)
 
         return build_response()
 
+    @action(methods=['post'], detail=False)
+    def batch_content(self, request):
+        """
+        Adds and removes contents of several folders at once
+        Takes a list of changes, each {"folder_id": 1, "add": [content ids], "remove": [content ids]}
+        """
+        changes = request.data.get("changes", None)
+        if not isinstance(changes, list) or not all(isinstance(change, dict) for change in changes):
+            return build_response(
+                status=status.HTTP_400_BAD_REQUEST,
+                success=False,
+                error="No changes supplied"
+            )
+
+        try:
+            result = change_folder_contents([
+                (change.get("folder_id"), change.get("add", []), change.get("remove", []))
+                for change in changes
+            ])
+        except ValidationError as e:
+            return build_response(status=status.HTTP_400_BAD_REQUEST, success=False, error=e.messages)
+
+        return build_response(result)
+
 
 class LibraryModuleViewSet(StandardDataView, viewsets.ModelViewSet):
     queryset = LibraryModule.objects.all()
     serializer_class = LibraryModuleSerializer
 
 
+class ImportJobViewSet(StandardDataView, viewsets.ReadOnlyModelViewSet):
+    queryset = ImportJob.objects.all()
+    serializer_class = ImportJobSerializer
+    pagination_class = PageNumberSizePagination
+
+
+class LibraryBuildViewSet(StandardDataView, mixins.CreateModelMixin, viewsets.ReadOnlyModelViewSet):
+    """
+    Library database builds, run in the background by the process_jobs worker
+    POST a version to queue a build, poll it until its state is finished, then GET download/
+    Builds queued with package set can also be fetched as a tar of the whole library from package/,
+    and builds queued with a base_version as a tar of the update from that version from delta/.
+    Builds of a version share their output paths, so once a later build replaces a file, fetching it returns 410
+    """
+    queryset = LibraryBuild.objects.all()
+    serializer_class = LibraryBuildSerializer
+    pagination_class = PageNumberSizePagination
+
+    def get_queryset(self):
+        queryset = self.queryset
+
+        version = self.request.GET.get("version", None)
+        if version != None:
+            queryset = queryset.filter(version_id=version)
+
+        return queryset
+
+    def create(self, request, *args, **kwargs):
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        serializer.save()
+        return build_response(serializer.data, status=status.HTTP_202_ACCEPTED)
+
+    @action(methods=['get'], detail=True)
+    def download(self, request, pk=None):
+        build = self.get_object()
+        if build.state != LibraryBuild.FINISHED:
+            return build_response(status=status.HTTP_409_CONFLICT, success=False, error="Build has not finished")
+        superseded_by = build.superseded_by()
+        if superseded_by is not None:
+            return self.superseded_response(superseded_by)
+        if not os.path.isfile(build.output_path):
+            return build_response(status=status.HTTP_404_NOT_FOUND, success=False, error="Build file no longer exists")
+        return FileResponse(open(build.output_path, 'rb'), as_attachment=True,
+                            filename=os.path.basename(build.output_path))
+
+    @action(methods=['get'], detail=True)
+    def package(self, request, pk=None):
+        build = self.get_object()
+        return self.stream_directory(build, build.package_path, "Build has no package",
+                                     'solarspell-{}.tar'.format(build.version_id), package=True)
+
+    @action(methods=['get'], detail=True)
+    def delta(self, request, pk=None):
+        build = self.get_object()
+        return self.stream_directory(build, build.delta_path, "Build has no delta package",
+                                     'solarspell-{}-to-{}.tar'.format(build.base_version_id, build.version_id),
+                                     base_version_id=build.base_version_id)
+
+    def stream_directory(self, build, path, missing_error, file_name, **outputs):
+        """
+        :param outputs: filters for later builds that replace the directory, see LibraryBuild.superseded_by
+        """
+        if build.state != LibraryBuild.FINISHED:
+            return build_response(status=status.HTTP_409_CONFLICT, success=False, error="Build has not finished")
+        if path is None or not os.path.isdir(path):
+            return build_response(status=status.HTTP_404_NOT_FOUND, success=False, error=missing_error)
+        superseded_by = build.superseded_by(**outputs)
+        if superseded_by is not None:
+            return self.superseded_response(superseded_by)
+        response = StreamingHttpResponse(iter_tar_stream(path), content_type='application/x-tar')
+        response['Content-Disposition'] = 'attachment; filename="{}"'.format(file_name)
+        return response
+
+    def superseded_response(self, superseded_by):
+        return build_response(
+            {'superseded_by': superseded_by.id},
+            status=status.HTTP_410_GONE,
+            success=False,
+            error="Build {} of this version replaced the files of this build".format(superseded_by.id)
+        )
+
+
+class UploadSessionViewSet(StandardDataView, mixins.CreateModelMixin, mixins.RetrieveModelMixin,
+                          mixins.DestroyModelMixin, viewsets.GenericViewSet):
+    """
+    Resumable uploads of large content files
+    Create a session with file_name and total_size, PUT the bytes to chunk/?offset=<received>
+    until received equals total_size, then POST the content fields to finalize/.
+    After a dropped connection, GET the session and continue from received.
+    """
+    queryset = UploadSession.objects.all()
+    serializer_class = UploadSessionSerializer
+
+    @action(methods=['put'], detail=True)
+    def chunk(self, request, pk=None):
+        session = self.get_object()
+        try:
+            offset = int(request.query_params.get("offset", None))
+        except (TypeError, ValueError):
+            return build_response(
+                status=status.HTTP_400_BAD_REQUEST,
+                success=False,
+                error="No Offset supplied"
+            )
+        # a client retrying a chunk that timed out waits here until the first attempt is written,
+        # then gets the offset it reached instead of writing the same bytes concurrently
+        with transaction.atomic():
+            session = UploadSession.objects.select_for_update().get(pk=session.pk)
+            if offset != session.received:
+                return build_response(
+                    UploadSessionSerializer(session).data,
+                    status=status.HTTP_409_CONFLICT,
+                    success=False,
+                    error="Expected offset {}".format(session.received)
+                )
+            try:
+                append_upload_chunk(session, request.stream)
+            except ValidationError as e:
+                return build_response(status=status.HTTP_400_BAD_REQUEST, success=False, error=e.messages)
+        return build_response(UploadSessionSerializer(session).data)
+
+    @action(methods=['post'], detail=True)
+    def finalize(self, request, pk=None):
+        session = self.get_object()
+        serializer = UploadedContentSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        content = Content()
+        with transaction.atomic():
+            # a chunk still being written, or a second finalize, waits until this one is done
+            session = UploadSession.objects.select_for_update().get(pk=session.pk)
+            try:
+                staged = finalize_upload_session(session)
+            except ValidationError as e:
+                return build_response(status=status.HTTP_400_BAD_REQUEST, success=False, error=e.messages)
+            try:
+                commit_staged_file(staged, content)
+            except ValidationError as e:
+                # the uploaded file is a duplicate and has been discarded
+                session.delete()
+                return build_response(status=status.HTTP_400_BAD_REQUEST, success=False, error=e.messages)
+            try:
+                content = serializer.save(
+                    content_file=content.content_file.name,
+                    file_name=content.file_name,
+                    filesize=content.filesize,
+                    content_hash=content.content_hash
+                )
+            except Exception:
+                # put the file back so the session can be finalized again
+                os.replace(content.content_file.path, session.part_path())
+                raise
+            session.delete()
+        return build_response(ContentSerializer(content).data, status=status.HTTP_201_CREATED)
+
+
 class BulkAddView(views.APIView):
+    # request bodies that are stored as they are and read incrementally by the worker
+    STREAMED_FORMATS = {
+        'application/x-ndjson': 'ndjson',
+        'application/ndjson': 'ndjson',
+        'text/csv': 'csv',
+        'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet': 'xlsx',
+    }
+    # formats of sheets uploaded as the sheet_file field of a multipart form
+    SHEET_FILE_EXTENSIONS = {
+        '.json': 'json',
+        '.ndjson': 'ndjson',
+        '.jsonl': 'ndjson',
+        '.csv': 'csv',
+        '.xlsx': 'xlsx',
+    }
 
     def post(self, request):
-        sheet_util = ContentSheetUtil()
-        content_data = request.data
-        result = sheet_util.upload_sheet_contents(content_data)
-        response = build_response(result)
-        return response
+        """
+        Queues the sheet for the process_jobs worker and returns the job right away
+        Accepts a JSON body with sheet_data and content_path, a multipart form
+        with a sheet_file (.xlsx, .csv, .ndjson or .json) and content_path, or an
+        NDJSON, CSV or XLSX body with content_path given as a query parameter.
+        Setting incremental to true skips files that earlier imports already added.
+        Progress can be polled from /api/import_jobs/<id>/
+        """
+        sheet_format = self.STREAMED_FORMATS.get(request.content_type.split(';')[0].strip())
+        if sheet_format is not None:
+            if request.stream is None:
+                return build_response(
+                    status=status.HTTP_400_BAD_REQUEST,
+                    success=False,
+                    error="No Sheet Data supplied"
+                )
+            job = ImportJob(
+                content_path=request.query_params.get("content_path", ""),
+                sheet_format=sheet_format,
+                incremental=request.query_params.get("incremental", "").lower() == "true"
+            )
+            # copied to storage in chunks, the body is never held in memory
+            job.sheet_file.save("sheet." + sheet_format, File(request.stream), save=False)
+            job.save()
+            return build_response(ImportJobSerializer(job).data, status=status.HTTP_202_ACCEPTED)
+
+        sheet_file = request.FILES.get("sheet_file", None)
+        if sheet_file is not None:
+            sheet_format = self.SHEET_FILE_EXTENSIONS.get(os.path.splitext(sheet_file.name)[1].lower())
+            if sheet_format is None:
+                return build_response(
+                    status=status.HTTP_400_BAD_REQUEST,
+                    success=False,
+                    error="Unsupported Sheet File type"
+                )
+            job = ImportJob(
+                content_path=request.data.get("content_path", ""),
+                sheet_format=sheet_format,
+                incremental=str(request.data.get("incremental", "")).lower() == "true"
+            )
+            job.sheet_file.save("sheet." + sheet_format, sheet_file, save=False)
+            job.save()
+            return build_response(ImportJobSerializer(job).data, status=status.HTTP_202_ACCEPTED)
+
+        sheet_data = request.data.get("sheet_data", None)
+        if sheet_data is None:
+            return build_response(
+                status=status.HTTP_400_BAD_REQUEST,
+                success=False,
+                error="No Sheet Data supplied"
+            )
+        if not isinstance(sheet_data, str):
+            sheet_data = json.dumps(sheet_data)
+        job = ImportJob(
+            content_path=request.data.get("content_path", ""),
+            incremental=str(request.data.get("incremental", "")).lower() == "true"
+        )
+        job.sheet_file.save("sheet.json", ContentFile(sheet_data.encode("utf-8")), save=False)
+        job.save()
+        return build_response(ImportJobSerializer(job).data, status=status.HTTP_202_ACCEPTED)
 
 
 class LibraryBuildView(views.APIView):
 
     def get(self, request, *args, **kwargs):
-        version_id = int(kwargs['version_id'])
-        build_util = LibraryBuildUtil()
-        result = build_util.build_library(version_id)
-        response = build_response(result)
-        return response
+        version = get_object_or_404(LibraryVersion, id=int(kwargs['version_id']))
+        build = LibraryBuild.objects.create(version=version)
+        return build_response(LibraryBuildSerializer(build).data, status=status.HTTP_202_ACCEPTED)
 
 @api_view(('GET',))
 @staff_member_required
@@ -134,6 +134,17 @@ CONTENTS_URL = '/media/contents/'
 BUILDS_ROOT = env.str('BUILDS_ROOT')
 BUILDS_URL = '/builds/'
 
+# Number of threads that copy and hash files during a bulk content import
+IMPORT_WORKERS = env.int('IMPORT_WORKERS', default=4)
+# Number of sheet rows inserted per transaction during a bulk content import
+IMPORT_CHUNK_SIZE = env.int('IMPORT_CHUNK_SIZE', default=500)
+# Number of rows fetched at a time from each query while writing a library database
+BUILD_CHUNK_SIZE = env.int('BUILD_CHUNK_SIZE', default=2000)
+# Hours after its last chunk that an unfinished upload session and its partial file are deleted
+UPLOAD_SESSION_EXPIRY_HOURS = env.int('UPLOAD_SESSION_EXPIRY_HOURS', default=24)
+# Minutes after which a running job that its worker stopped refreshing is failed
+JOB_STALE_MINUTES = env.int('JOB_STALE_MINUTES', default=5)
+
 # Settings for rest_framework library
 REST_FRAMEWORK = {
     'DEFAULT_FILTER_BACKENDS': ['django_filters.rest_framework.DjangoFilterBackend'],
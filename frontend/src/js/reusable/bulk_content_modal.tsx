@@ -2,7 +2,7 @@ import ActionDialog from "./action_dialog"
 import { isUndefined } from "lodash"
 import {Button, Container, Typography, TextField} from "@material-ui/core"
 import Axios, { AxiosResponse } from "axios"
-import { APP_URLS } from "../urls"
+import { APP_URLS, get_data } from "../urls"
 import { Component } from 'react'
 import React from 'react'
 import {update_state, get_string_from_error, read_excel_file} from '../utils'
@@ -21,7 +21,28 @@ interface BulkContentModalProps {
 interface BulkContentModalState {
         error_table_rows: any // to display unsuccessful upload attempts
         bulk_content_path: string // to hold actual content files
-        bulk_metadata: any // to hold content metadata
+}
+
+//Polls an import job queued by the bulk add endpoint until the worker is done with it
+//Gives up once the job's updated_on, refreshed by a worker running it, has not changed for stall_ms
+function wait_for_import_job(
+    job_id: number, interval_ms: number = 2000, stall_ms: number = 10 * 60 * 1000,
+    last_update: string = "", last_update_seen: number = Date.now()
+): Promise<any> {
+    return get_data(APP_URLS.IMPORT_JOB(job_id)).then((job: any) => {
+        if (job.state === "finished") return job
+        if (job.state === "failed") return Promise.reject({response: {data: {error: job.error}}})
+        if (job.updated_on !== last_update) {
+            last_update = job.updated_on
+            last_update_seen = Date.now()
+        } else if (Date.now() - last_update_seen > stall_ms) {
+            return Promise.reject({response: {data: {
+                error: "The import job is not making progress, check that the process_jobs worker is running"
+            }}})
+        }
+        return new Promise(resolve => setTimeout(resolve, interval_ms))
+            .then(() => wait_for_import_job(job_id, interval_ms, stall_ms, last_update, last_update_seen))
+    })
 }
 
 //This modal should be used to add bulk content with metadata excel sheet.
@@ -39,7 +60,6 @@ export default class BulkContentModal extends Component<BulkContentModalProps, B
         this.error_table_columns = [{name:"file_name", title: "File Name"},{name:"error", title:"Error"}]
         this.state = {
             bulk_content_path: "",
-            bulk_metadata: null,
             error_table_rows: []
         }
         this.update_state = update_state.bind(this)
@@ -69,31 +89,37 @@ export default class BulkContentModal extends Component<BulkContentModalProps, B
                         key={2}
                         onClick={() => {
                             this.props.show_loader()
-                                read_excel_file(this.bulk_add_sheet_ref.current?.files?.item(0))
-                                .then(jsonArray => {
-                                    this.update_state(draft => {
-                                        draft.bulk_metadata = jsonArray;
-                                    })
-                                })
-                                .then(() => {
-                                    const axios_response = Axios.post(APP_URLS.CONTENT_BULK,
-                                        {"sheet_data":this.state.bulk_metadata,
-                                            "content_path": this.state.bulk_content_path})
-                                    axios_response.then((_res?: AxiosResponse<any>) => {
-                                        this.props.remove_loader()
-                                        this.props.show_toast_message(`${_res?.data?.data?.success_count} Content Added Successfully`,true)
-                                        this.update_state(draft => {
-                                            draft.error_table_rows = []
-                                            draft.error_table_rows = _res?.data?.data?.unsuccessful_uploads
-                                         })
-                                    }, (reason: any) => {
-                                        this.props.remove_loader()
-                                        const unknown_err_str =  "Error while adding bulk content"
-                                        this.props.show_toast_message(get_string_from_error(
-                                            isUndefined(reason?.response?.data?.error) ? reason?.response?.data?.error : unknown_err_str,
-                                            unknown_err_str
-                                        ),false)
-                                    })
+                            const sheet_file = this.bulk_add_sheet_ref.current?.files?.item(0)
+                            let queue_import: Promise<AxiosResponse<any>>
+                            if (/\.(xlsx|csv)$/i.test(sheet_file?.name ?? "")) {
+                                // the server reads these sheets itself, so they are uploaded as is
+                                const form_data = new FormData()
+                                form_data.append("sheet_file", sheet_file as Blob)
+                                form_data.append("content_path", this.state.bulk_content_path)
+                                queue_import = Axios.post(APP_URLS.CONTENT_BULK, form_data)
+                            } else {
+                                // other workbooks, such as .xls and .ods, are converted to rows here
+                                queue_import = read_excel_file(sheet_file).then(json_array => Axios.post(
+                                    APP_URLS.CONTENT_BULK,
+                                    {"sheet_data": json_array, "content_path": this.state.bulk_content_path}
+                                ))
+                            }
+                            queue_import
+                            .then((_res?: AxiosResponse<any>) => wait_for_import_job(_res?.data?.data?.id))
+                            .then((job: any) => {
+                                this.props.remove_loader()
+                                this.props.show_toast_message(`${job?.result?.success_count} Content Added Successfully`,true)
+                                this.update_state(draft => {
+                                    draft.error_table_rows = []
+                                    draft.error_table_rows = job?.result?.unsuccessful_uploads
+                                 })
+                            }, (reason: any) => {
+                                this.props.remove_loader()
+                                const unknown_err_str =  "Error while adding bulk content"
+                                this.props.show_toast_message(get_string_from_error(
+                                    isUndefined(reason?.response?.data?.error) ? reason?.response?.data?.error : unknown_err_str,
+                                    unknown_err_str
+                                ),false)
                             })
                         }}
                         color="primary"
@@ -52,6 +52,7 @@ const APP_URLS = {
         url_with_params(`${api_path}/contents/`, get_filters_arr(page, size, filters, exclude_if_in_version)),
     CONTENT_ITEM: (id: number) => url_with_params(`${api_path}/contents/${id}/`),
     CONTENT_BULK: url_with_params(`${api_path}/content_bulk_add/`),
+    IMPORT_JOB: (id: number) => url_with_params(`${api_path}/import_jobs/${id}/`),
     CONTENT_BULK_DOWNLOAD: (filters?: content_filters) =>
         url_with_params(`${api_path}/contents/get_spreadsheet/`, get_filters_arr(undefined, undefined, filters)),
     CONTENT_FOLDER: url_with_params("media/contents/"),